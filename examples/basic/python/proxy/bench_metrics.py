@@ -0,0 +1,76 @@
+"""
+Microbenchmark for the proxy's /metrics instrumentation.
+
+Replays the metric updates a single streamed chat completion makes (clock
+reads, five histogram observations, counter and gauge updates) and reports
+the added cost per request. Exits non-zero when it is over budget.
+
+Usage:
+    python bench_metrics.py [--requests 200000] [--budget-us 5]
+"""
+
+import sys
+import time
+import argparse
+
+from metrics import ProxyMetrics
+
+
+class FakeUpstream:
+    class stats:
+        in_flight = 0
+
+    max_connections = 100
+
+
+def instrumented_request(metrics, model):
+    started = time.perf_counter()
+    metrics.parse_seconds.observe(time.perf_counter() - started)
+    metrics.in_flight.inc()
+    upstream_started = time.perf_counter()
+    metrics.connect_seconds.observe(0.02)
+    metrics.ttfb_seconds.observe(time.perf_counter() - upstream_started)
+    first = time.perf_counter()
+    metrics.upstream_seconds.observe(time.perf_counter() - upstream_started)
+    metrics.stream_seconds.observe(time.perf_counter() - first)
+    metrics.requests.inc("200", model)
+    metrics.in_flight.dec()
+
+
+def bare_request(metrics, model):
+    pass
+
+
+def timed(fn, metrics, count):
+    started = time.perf_counter()
+    for _ in range(count):
+        fn(metrics, "shapesinc/beta-1q75")
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200000)
+    parser.add_argument("--budget-us", type=float, default=5.0, help="allowed instrumentation cost per request")
+    args = parser.parse_args()
+
+    metrics = ProxyMetrics(FakeUpstream())
+    bare = timed(bare_request, metrics, args.requests)
+    instrumented = timed(instrumented_request, metrics, args.requests)
+    per_request = (instrumented - bare) / args.requests * 1e6
+
+    started = time.perf_counter()
+    body = metrics.render()
+    render_ms = (time.perf_counter() - started) * 1000
+
+    print(f"requests:          {args.requests}")
+    print(f"overhead/request:  {per_request:.3f} us (budget {args.budget_us} us)")
+    print(f"/metrics render:   {render_ms:.3f} ms, {len(body)} bytes")
+
+    if per_request > args.budget_us:
+        print("instrumentation is over budget")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Microbenchmark for synthetic SSE framing.
+
+Compares the old per-character `fake_stream` (json.dumps of a fresh dict for
+every character) against the template-based Framer for each chunk policy.
+Pacing sleeps are left out so only framing cost is measured; the old
+implementation's 10 ms per character sleep is reported separately.
+
+Usage:
+    python bench_sse.py [--chars 2000] [--repeat 200]
+"""
+
+import json
+import time
+import asyncio
+import argparse
+
+from sse import CHUNK_POLICIES, Framer
+
+SAMPLE = (
+    "Shapes are general purpose social agents. They remember you, hang out in "
+    "your group chats and answer with their own personality — même en français, "
+    "日本語でも, and with emoji 🎉. "
+)
+
+
+def legacy_frames(completion):
+    # The original fake_stream body, minus the asyncio.sleep(0.01)
+    for char in completion:
+        chunk = {
+            "choices": [
+                {
+                    "delta": {"content": char},
+                    "finish_reason": None,
+                }
+            ]
+        }
+        yield f"data: {json.dumps(chunk)}\n\n".encode()
+    yield b"data: [DONE]\n\n"
+
+
+async def collect(stream):
+    writes = 0
+    size = 0
+    async for data in stream:
+        writes += 1
+        size += len(data)
+    return writes, size
+
+
+async def legacy_stream(completion):
+    for frame in legacy_frames(completion):
+        yield frame
+
+
+def run(name, make_stream, frames, repeat):
+    writes, size = asyncio.run(collect(make_stream()))
+    started = time.perf_counter()
+    for _ in range(repeat):
+        asyncio.run(collect(make_stream()))
+    elapsed = (time.perf_counter() - started) / repeat
+    print(
+        f"{name:<14} frames={frames:>6} writes={writes:>6} bytes={size:>8} "
+        f"time={elapsed * 1000:>8.3f}ms frames/s={frames / elapsed:>12,.0f}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chars", type=int, default=2000, help="completion length in characters")
+    parser.add_argument("--repeat", type=int, default=200, help="iterations per implementation")
+    args = parser.parse_args()
+
+    completion = (SAMPLE * (args.chars // len(SAMPLE) + 1))[:args.chars]
+    print(f"completion: {len(completion)} chars, {len(completion.encode())} bytes")
+    print(f"legacy pacing alone would add {len(completion) * 0.01:.1f}s per response\n")
+
+    run("legacy", lambda: legacy_stream(completion), len(completion) + 1, args.repeat)
+    for policy in CHUNK_POLICIES:
+        framer = Framer(policy=policy)
+        frames = sum(1 for _ in framer.frames(completion))
+        run(policy, lambda: framer.stream(completion), frames, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
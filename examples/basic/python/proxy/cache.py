@@ -0,0 +1,353 @@
+import re
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class CachedResponse:
+    """An upstream response kept as raw bytes, ready to be sent again."""
+
+    def __init__(self, body, status_code, content_type, etag=None):
+        self.body = body
+        self.status_code = status_code
+        self.content_type = content_type
+        self.etag = etag
+        self.fetched_at = time.monotonic()
+
+    def age(self):
+        return time.monotonic() - self.fetched_at
+
+    def dump(self):
+        # Wall-clock fetch time, since other workers have their own monotonic clocks
+        head = {
+            "status_code": self.status_code,
+            "content_type": self.content_type,
+            "etag": self.etag,
+            "fetched": time.time() - self.age(),
+        }
+        return json.dumps(head).encode() + b"\n" + self.body
+
+    @classmethod
+    def load(cls, blob):
+        head, body = blob.split(b"\n", 1)
+        head = json.loads(head)
+        cached = cls(body, head["status_code"], head["content_type"], head["etag"])
+        cached.fetched_at = time.monotonic() - max(0.0, time.time() - head["fetched"])
+        return cached
+
+
+class ModelsCache:
+    """TTL cache for GET /v1/models with stale-while-revalidate.
+
+    `fetch(etag)` performs the upstream call and returns an httpx.Response.
+    Only a cold cache makes callers wait; once an entry exists it is served
+    immediately and refreshed in the background after `ttl` seconds. At most
+    one refresh runs at a time, and a 304 answer to If-None-Match just
+    renews the existing entry.
+
+    With a shared `state`, a refresh first adopts a fresh entry another
+    worker already fetched, and publishes what it fetches itself.
+    """
+
+    def __init__(self, fetch, ttl=60.0, state=None, key="models"):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.state = state
+        self.key = key
+        self.entry = None
+        self._refresh = None
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.revalidated = 0
+        self.shared_hits = 0
+        self.refresh_errors = 0
+
+    async def get(self):
+        entry = self.entry
+        if entry is None:
+            self.misses += 1
+            # Callers arriving while the first fetch is running share it
+            return await asyncio.shield(self._start_refresh())
+        if entry.age() > self.ttl:
+            self.stale_hits += 1
+            self._start_refresh()
+        else:
+            self.hits += 1
+        return entry
+
+    def _start_refresh(self):
+        if self._refresh is None or self._refresh.done():
+            self._refresh = asyncio.create_task(self._do_refresh())
+        return self._refresh
+
+    async def _shared(self):
+        try:
+            blob = await self.state.get(self.key)
+        except Exception as e:
+            logger.warning(f"Shared models lookup failed: {e}")
+            return None
+        if blob is None:
+            return None
+        shared = CachedResponse.load(blob)
+        return shared if shared.age() <= self.ttl else None
+
+    async def _do_refresh(self):
+        entry = self.entry
+        if self.state is not None:
+            shared = await self._shared()
+            if shared is not None:
+                self.shared_hits += 1
+                self.entry = shared
+                return shared
+
+        try:
+            r = await self.fetch(entry.etag if entry else None)
+        except Exception as e:
+            self.refresh_errors += 1
+            if entry is None:
+                raise
+            logger.warning(f"Models refresh failed, serving stale entry: {e}")
+            return entry
+
+        if r.status_code == 304 and entry is not None:
+            self.revalidated += 1
+            entry.fetched_at = time.monotonic()
+            self._publish(entry)
+            return entry
+
+        fresh = CachedResponse(
+            r.content,
+            r.status_code,
+            r.headers.get("content-type", "application/json"),
+            r.headers.get("etag"),
+        )
+        if r.status_code == 200:
+            self.entry = fresh
+            self._publish(fresh)
+        elif entry is not None:
+            # Keep serving the last good list rather than an upstream error
+            self.refresh_errors += 1
+            logger.warning(f"Models refresh returned {r.status_code}, serving stale entry")
+            return entry
+        return fresh
+
+    def _publish(self, entry):
+        if self.state is not None:
+            self.state.publish(self.key, entry.dump(), self.ttl * 2)
+
+    def stats(self):
+        return {
+            "ttl": self.ttl,
+            "age": round(self.entry.age(), 3) if self.entry else None,
+            "etag": self.entry.etag if self.entry else None,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "revalidated": self.revalidated,
+            "shared_hits": self.shared_hits,
+            "refresh_errors": self.refresh_errors,
+        }
+
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+
+
+def normalize(text):
+    # Case, punctuation and spacing differences do not make a prompt new
+    return " ".join(_PUNCTUATION.sub("", (text or "").lower()).split())
+
+
+def simhash(text, bits=64):
+    """64-bit SimHash over word unigrams and bigrams of normalized text."""
+    words = text.split()
+    features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    if not features:
+        return 0
+    # Count set bits column-wise over the binary strings; much cheaper than shifting per bit
+    rows = [
+        format(int.from_bytes(hashlib.blake2b(f.encode(), digest_size=bits // 8).digest(), "big"), f"0{bits}b")
+        for f in features
+    ]
+    half = len(rows) / 2
+    return int("".join("1" if column.count("1") > half else "0" for column in zip(*rows)), 2)
+
+
+def parse_ttls(spec):
+    # "shapesinc/a=60,shapesinc/b=600" -> {"shapesinc/a": 60.0, "shapesinc/b": 600.0}
+    ttls = {}
+    for item in (spec or "").split(","):
+        if "=" in item:
+            model, ttl = item.rsplit("=", 1)
+            ttls[model.strip()] = float(ttl)
+    return ttls
+
+
+class _Entry:
+    def __init__(self, scope, text, fingerprint, body, content_type, expires_at):
+        self.scope = scope
+        self.text = text
+        self.fingerprint = fingerprint
+        self.body = body
+        self.content_type = content_type
+        self.expires_at = expires_at
+        self.size = len(body) + len(text) + 200
+
+
+class ResponseCache:
+    """LRU cache of completion responses with near-duplicate lookup.
+
+    Entries are scoped (model, user and channel or just model, plus stream
+    mode) and keyed on normalized prompt text. A miss on the exact text falls
+    back to a SimHash index: the 64-bit fingerprint is cut into
+    `max_distance + 1` bands, so any fingerprint within `max_distance` bits
+    shares at least one band exactly and is found without a full scan.
+    Entries expire after a per-model TTL, and the least recently used ones are
+    evicted once the cache holds more than `max_bytes`.
+
+    With a shared `state`, new entries are published for other workers and a
+    local miss checks the shared state for the exact prompt before giving up.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=300.0, model_ttls=None, max_distance=0, state=None):
+        self.state = state
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.model_ttls = model_ttls or {}
+        self.max_distance = max_distance
+        self.bands = max_distance + 1
+        self.band_bits = -(-64 // self.bands)
+        self.entries = OrderedDict()
+        self.index = {}
+        self.bytes = 0
+        self.hits = 0
+        self.near_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _band_keys(self, scope, fingerprint):
+        mask = (1 << self.band_bits) - 1
+        for band in range(self.bands):
+            yield (scope, band, fingerprint >> (band * self.band_bits) & mask)
+
+    async def get(self, scope, text):
+        normalized = normalize(text)
+        if not normalized:
+            return None
+        entry, near = self._local(scope, normalized)
+        if entry is None and self.state is not None:
+            entry = await self._shared(scope, normalized)
+            if entry is not None:
+                self.shared_hits += 1
+                return entry
+
+        if entry is None:
+            self.misses += 1
+        elif near:
+            self.near_hits += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def _local(self, scope, normalized):
+        entry = self.entries.get((scope, normalized))
+        near = False
+        if entry is None and self.max_distance > 0:
+            entry = self._nearest(scope, simhash(normalized))
+            near = entry is not None
+        if entry is None:
+            return None, False
+        if entry.expires_at < time.monotonic():
+            self._remove((entry.scope, entry.text))
+            return None, False
+        self.entries.move_to_end((entry.scope, entry.text))
+        return entry, near
+
+    def _shared_key(self, scope, normalized):
+        return "response:" + hashlib.blake2b(repr((scope, normalized)).encode(), digest_size=16).hexdigest()
+
+    async def _shared(self, scope, normalized):
+        # Exact matches only; the SimHash index stays local to each worker
+        try:
+            blob = await self.state.get(self._shared_key(scope, normalized))
+        except Exception as e:
+            logger.warning(f"Shared response cache lookup failed: {e}")
+            return None
+        if blob is None:
+            return None
+        head, body = blob.split(b"\n", 1)
+        head = json.loads(head)
+        remaining = head["expires"] - time.time()
+        if remaining <= 0:
+            return None
+        return self._insert(scope, normalized, body, head["content_type"], remaining)
+
+    def _nearest(self, scope, fingerprint):
+        best = None
+        best_distance = self.max_distance + 1
+        for band_key in self._band_keys(scope, fingerprint):
+            for key in self.index.get(band_key, ()):
+                entry = self.entries[key]
+                distance = bin(entry.fingerprint ^ fingerprint).count("1")
+                if distance < best_distance:
+                    best, best_distance = entry, distance
+        return best
+
+    def put(self, scope, model, text, body, content_type):
+        normalized = normalize(text)
+        if not normalized:
+            return
+        ttl = self.model_ttls.get(model, self.ttl)
+        self._insert(scope, normalized, body, content_type, ttl)
+        if self.state is not None:
+            head = json.dumps({"content_type": content_type, "expires": time.time() + ttl}).encode()
+            self.state.publish(self._shared_key(scope, normalized), head + b"\n" + body, ttl)
+
+    def _insert(self, scope, normalized, body, content_type, ttl):
+        key = (scope, normalized)
+        self._remove(key)
+        entry = _Entry(scope, normalized, simhash(normalized), body, content_type, time.monotonic() + ttl)
+        if entry.size > self.max_bytes:
+            return entry
+
+        self.entries[key] = entry
+        self.bytes += entry.size
+        for band_key in self._band_keys(scope, entry.fingerprint):
+            self.index.setdefault(band_key, set()).add(key)
+        while self.bytes > self.max_bytes:
+            self._remove(next(iter(self.entries)))
+            self.evictions += 1
+        return entry
+
+    def _remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.bytes -= entry.size
+        for band_key in self._band_keys(entry.scope, entry.fingerprint):
+            keys = self.index.get(band_key)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.index[band_key]
+
+    def stats(self):
+        found = self.hits + self.near_hits + self.shared_hits
+        lookups = found + self.misses
+        return {
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "near_hits": self.near_hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(found / lookups, 4) if lookups else 0.0,
+        }
@@ -0,0 +1,154 @@
+import json
+import time
+import hashlib
+import logging
+import secrets
+from logging.handlers import RotatingFileHandler
+
+logger = logging.getLogger(__name__)
+
+
+def _digest(text, key):
+    # Keyed, so low-entropy ids (phone numbers, short handles) can't be recovered
+    # by hashing every candidate without the key
+    return hashlib.blake2b(str(text).encode(), key=key, digest_size=16).hexdigest()
+
+
+def redact_text(text, key):
+    # Exactly the original length and the same placeholder for the same text, so
+    # replayed load and cache/coalescing behavior match the original traffic
+    if not isinstance(text, str) or not text:
+        return text
+    return (_digest(text, key) + " " + "x" * len(text))[:len(text)]
+
+
+def redact_body(body, key):
+    redacted = dict(body)
+    messages = []
+    for message in body.get("messages") or []:
+        if isinstance(message, dict):
+            message = {**message, "content": redact_text(message.get("content"), key)}
+        messages.append(message)
+    redacted["messages"] = messages
+    return redacted
+
+
+class CapturedRequest:
+    """Timings of one chat completion, written to the capture log when it finishes."""
+
+    def __init__(self, capture, body, user_id, channel_id):
+        self.capture = capture
+        self.body = body
+        self.user_id = user_id
+        self.channel_id = channel_id
+        self.arrived = time.time()
+        self.started = time.perf_counter()
+        self.first_at = None
+        self.upstream_ttfb = None
+        self.upstream_duration = None
+        self.size = 0
+        self.done = False
+
+    def first(self):
+        if self.first_at is None:
+            self.first_at = time.perf_counter()
+
+    def upstream_first(self, seconds):
+        # Upstream send to first byte, without the proxy's cache lookup, queueing and heartbeats
+        self.upstream_ttfb = seconds
+
+    def upstream_end(self, seconds):
+        self.upstream_duration = seconds
+
+    def add(self, size):
+        self.size += size
+
+    def finish(self, status, size=None, cached=False):
+        if self.done:
+            return
+        self.done = True
+        ended = time.perf_counter()
+        self.capture.write(
+            self,
+            status,
+            self.size if size is None else size,
+            (self.first_at or ended) - self.started,
+            ended - self.started,
+            cached,
+        )
+
+
+class TrafficCapture:
+    """Appends one compact JSON line per chat completion to a rotating log.
+
+    Each line holds the arrival time, request body, user and channel, status,
+    time to first byte, total time and response size as the client saw them,
+    and, for requests that called the upstream, the upstream's own time to
+    first byte and total time. replay.py reads these
+    files back; mock_upstream.py can replay the recorded latencies and sizes.
+    With `redact`, message text is replaced by same-length placeholders and
+    user and channel ids are hashed, both keyed with `redact_key`. Without a
+    key a random one is used, so placeholders only match within one process.
+    """
+
+    def __init__(self, path, max_bytes=50 * 1024 * 1024, backups=3, redact=True, redact_key=""):
+        self.path = path
+        self.redact = redact
+        if redact and not redact_key:
+            logger.warning("No capture redaction key set, using a random one; placeholders won't match across restarts or workers")
+        self.redact_key = (redact_key.encode() if redact_key else secrets.token_bytes(32))[:64]
+        self.records = 0
+        self.log = logging.getLogger(f"{__name__}.{path}")
+        self.log.propagate = False
+        self.log.setLevel(logging.INFO)
+        handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8")
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self.log.addHandler(handler)
+        self.handler = handler
+
+    def begin(self, body, user_id, channel_id):
+        return CapturedRequest(self, body, user_id, channel_id)
+
+    def write(self, request, status, size, ttfb, duration, cached):
+        body, user_id, channel_id = request.body, request.user_id, request.channel_id
+        if self.redact:
+            key = self.redact_key
+            body, user_id, channel_id = redact_body(body, key), _digest(user_id, key), _digest(channel_id, key)
+        entry = {
+            "t": round(request.arrived, 4),
+            "user": user_id,
+            "channel": channel_id,
+            "status": status,
+            "ttfb_ms": round(ttfb * 1000, 1),
+            "ms": round(duration * 1000, 1),
+            "bytes": size,
+            "body": body,
+        }
+        if request.upstream_ttfb is not None:
+            entry["upstream_ttfb_ms"] = round(request.upstream_ttfb * 1000, 1)
+        if request.upstream_duration is not None:
+            entry["upstream_ms"] = round(request.upstream_duration * 1000, 1)
+        if cached:
+            entry["cached"] = True
+        self.log.info(json.dumps(entry, separators=(",", ":"), ensure_ascii=False))
+        self.records += 1
+
+    def close(self):
+        self.log.removeHandler(self.handler)
+        self.handler.close()
+
+    def stats(self):
+        return {"path": self.path, "records": self.records, "redact": self.redact}
+
+
+def read_capture(paths):
+    """Records from capture files (rotated backups included), oldest first."""
+    records = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    records.append(json.loads(line))
+    records.sort(key=lambda r: r["t"])
+    return records
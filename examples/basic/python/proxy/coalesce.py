@@ -0,0 +1,138 @@
+import asyncio
+import logging
+
+from sse import GuardedStream
+
+logger = logging.getLogger(__name__)
+
+
+def request_key(model, user_id, channel_id, text, stream):
+    # Whitespace-only differences still count as the same prompt
+    return (model, user_id, channel_id, " ".join((text or "").split()), stream)
+
+
+class Broadcast:
+    """Reads one byte stream in the background and replays it to every subscriber.
+
+    Subscribers that join late first receive the chunks they missed.
+    """
+
+    def __init__(self, source):
+        self.chunks = []
+        self.done = False
+        self.subscribers = 0
+        self._changed = asyncio.Event()
+        self.task = asyncio.create_task(self._pump(source))
+
+    async def _pump(self, source):
+        try:
+            async for chunk in source:
+                self.chunks.append(chunk)
+                self._notify()
+        except Exception as e:
+            logger.warning(f"Shared upstream stream failed: {e}")
+        finally:
+            if hasattr(source, "aclose"):
+                await source.aclose()
+            self.done = True
+            self._notify()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def subscribe(self):
+        self.subscribers += 1
+        return GuardedStream(self._replay(), cleanup=self._unsubscribe)
+
+    def _unsubscribe(self):
+        # Nobody is listening any more, so stop reading from upstream
+        self.subscribers -= 1
+        if not self.subscribers and not self.done:
+            self.task.cancel()
+
+    async def _replay(self):
+        i = 0
+        while True:
+            while i < len(self.chunks):
+                yield self.chunks[i]
+                i += 1
+            if self.done:
+                return
+            await self._changed.wait()
+
+
+class Coalescer:
+    """Singleflight for upstream completions.
+
+    Concurrent calls with the same key share one upstream call. `fn` returns
+    either a finished response, handed to every waiter, or an async byte
+    iterator, which is wrapped in a Broadcast so each waiter gets its own
+    replay of the stream. A key is released once its call, or its stream,
+    completes. If every waiter leaves before the call returns, the call is
+    cancelled, the same way a Broadcast stops once its last subscriber goes.
+    """
+
+    def __init__(self):
+        self.flights = {}
+        self.waiters = {}
+        self.hits = 0
+        self.misses = 0
+        self.abandoned = 0
+
+    async def run(self, key, fn, on_join=None):
+        # `on_join` is called when the call joins a flight instead of starting one
+        flight = self.flights.get(key)
+        if flight is None:
+            self.misses += 1
+            flight = asyncio.create_task(self._open(key, fn))
+            self.flights[key] = flight
+        else:
+            self.hits += 1
+            if on_join:
+                on_join()
+
+        self.waiters[flight] = self.waiters.get(flight, 0) + 1
+        try:
+            result = await asyncio.shield(flight)
+        finally:
+            self._leave(flight)
+        if isinstance(result, Broadcast):
+            return result.subscribe()
+        return result
+
+    def _leave(self, flight):
+        count = self.waiters.pop(flight) - 1
+        if count:
+            self.waiters[flight] = count
+        elif not flight.done():
+            # Nobody is waiting any more, so stop the upstream call
+            self.abandoned += 1
+            flight.cancel()
+
+    async def _open(self, key, fn):
+        try:
+            result = await fn()
+        except BaseException:
+            self._release(key)
+            raise
+
+        if hasattr(result, "__aiter__"):
+            broadcast = Broadcast(result)
+            broadcast.task.add_done_callback(lambda _: self._release(key))
+            return broadcast
+        self._release(key)
+        return result
+
+    def _release(self, key):
+        self.flights.pop(key, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "in_flight": len(self.flights),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 4) if total else 0.0,
+            "abandoned": self.abandoned,
+        }
@@ -0,0 +1,129 @@
+import math
+from bisect import bisect_left
+
+# Seconds, spanning sub-millisecond parsing up to multi-minute generations
+LATENCY_BUCKETS = (
+    0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0,
+)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+def _number(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self.values.items():
+            yield f"{self.name}{_labels(self.labels, labels)} {_number(value)}"
+
+
+class Gauge:
+    """A gauge set directly, or read from `fn` at scrape time."""
+
+    def __init__(self, name, help, fn=None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        yield f"{self.name} {_number(self.fn() if self.fn else self.value)}"
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            cumulative += count
+            yield f'{self.name}_bucket{{le="{_number(bound)}"}} {cumulative}'
+        yield f"{self.name}_sum {_number(self.sum)}"
+        yield f"{self.name}_count {self.count}"
+
+
+class Registry:
+    """Holds metrics and renders them in the Prometheus text exposition format."""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class ProxyMetrics:
+    """The proxy's request, upstream and pool metrics."""
+
+    def __init__(self, upstream):
+        self.registry = Registry()
+        add = self.registry.add
+        self.parse_seconds = add(Histogram("proxy_request_parse_seconds", "Time to read and parse the client request body"))
+        self.connect_seconds = add(Histogram("proxy_upstream_connect_seconds", "Time to open a new upstream connection, TLS included"))
+        self.ttfb_seconds = add(Histogram("proxy_upstream_ttfb_seconds", "Time from sending the upstream request to its first byte"))
+        self.upstream_seconds = add(Histogram("proxy_upstream_seconds", "Total time of an upstream call, body included"))
+        self.stream_seconds = add(Histogram("proxy_stream_duration_seconds", "Time from the first to the last chunk sent to the client"))
+        self.requests = add(Counter("proxy_requests_total", "Completed chat completion requests", ("status", "model")))
+        self.errors = add(Counter("proxy_errors_total", "Failed requests by error class", ("error",)))
+        self.disconnects = add(Counter("proxy_client_disconnects_total", "Clients that left before their response finished", ("phase",)))
+        self.in_flight = add(Gauge("proxy_requests_in_flight", "Chat completion requests being served"))
+        self.ws_sessions = add(Gauge("proxy_websocket_sessions", "Open /v1/ws sessions"))
+        add(Gauge("proxy_pool_in_flight", "Upstream requests using the connection pool", lambda: upstream.stats.in_flight))
+        add(Gauge("proxy_pool_max_connections", "Connection pool size", lambda: upstream.max_connections))
+
+    def render(self):
+        return self.registry.render()
@@ -0,0 +1,144 @@
+"""
+Local stand-in for the Shapes API, for testing and benchmarking the proxy.
+
+It echoes the last user message. Latency, saturation and errors are set from
+the environment:
+
+    MOCK_LATENCY=0.2            base seconds before the first byte
+    MOCK_LATENCY_PER_REQUEST=0  extra seconds per request already in flight
+    MOCK_JITTER=0               random extra latency, up to this many seconds
+    MOCK_CAPACITY=0             answer 429 beyond this many in-flight requests (0 = never)
+    MOCK_ERROR_RATE=0           fraction of requests answered with 503
+    MOCK_STREAM=true            honor "stream": true with word-by-word SSE
+    MOCK_TOKEN_DELAY=0.01       seconds between streamed words
+    MOCK_CAPTURE=               comma-separated proxy capture files; prompts found there get
+                                their recorded latency and response size back (see replay.py)
+
+Run it next to the proxy:
+
+    python -m uvicorn mock_upstream:app --port 9001
+    BASE_URL=http://127.0.0.1:9001 python -m uvicorn proxy:app
+"""
+
+import os
+import json
+import random
+import asyncio
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse, JSONResponse, Response
+
+MOCK_LATENCY = float(os.getenv("MOCK_LATENCY", "0.2"))
+MOCK_LATENCY_PER_REQUEST = float(os.getenv("MOCK_LATENCY_PER_REQUEST", "0"))
+MOCK_JITTER = float(os.getenv("MOCK_JITTER", "0"))
+MOCK_CAPACITY = int(os.getenv("MOCK_CAPACITY", "0"))
+MOCK_ERROR_RATE = float(os.getenv("MOCK_ERROR_RATE", "0"))
+MOCK_STREAM = os.getenv("MOCK_STREAM", "true").lower() == "true"
+MOCK_TOKEN_DELAY = float(os.getenv("MOCK_TOKEN_DELAY", "0.01"))
+MOCK_CAPTURE = os.getenv("MOCK_CAPTURE", "")
+
+MODELS_ETAG = '"mock-models-1"'
+
+app = FastAPI()
+state = {"in_flight": 0, "requests": 0, "replayed": 0}
+
+
+def load_capture(paths):
+    # The proxy forwards the first user message, so recorded shapes are keyed on it
+    from capture import read_capture
+
+    recorded = {}
+    for record in read_capture([p for p in paths.split(",") if p]):
+        if record.get("status") != 200 or record.get("cached"):
+            continue
+        measured = "upstream_ms" in record
+        if not measured:
+            # Coalesced requests and older captures only have client-side times, which
+            # include the proxy's queueing; use them only when nothing better was recorded
+            record = {**record, "upstream_ttfb_ms": record["ttfb_ms"], "upstream_ms": record["ms"]}
+        for message in record["body"].get("messages") or []:
+            if message.get("role") == "user":
+                key = message.get("content")
+                if measured or not recorded.get(key, {}).get("measured"):
+                    recorded[key] = {**record, "measured": measured}
+                break
+    return recorded
+
+
+recorded = load_capture(MOCK_CAPTURE) if MOCK_CAPTURE else {}
+
+
+def chunk(content, finish_reason=None):
+    return {
+        "object": "chat.completion.chunk",
+        "model": "mock",
+        "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": finish_reason}],
+    }
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    data = await request.json()
+    state["requests"] += 1
+
+    if MOCK_CAPACITY and state["in_flight"] >= MOCK_CAPACITY:
+        return JSONResponse(content={"error": "rate limited"}, status_code=429, headers={"Retry-After": "1"})
+    if random.random() < MOCK_ERROR_RATE:
+        return JSONResponse(content={"error": "unavailable"}, status_code=503)
+
+    messages = data.get("messages") or [{}]
+    text = f"Echo: {messages[-1].get('content', '')}"
+    replayed = recorded.get(messages[-1].get("content"))
+
+    state["in_flight"] += 1
+    try:
+        if replayed:
+            state["replayed"] += 1
+            delay = replayed["upstream_ttfb_ms"] / 1000
+        else:
+            delay = MOCK_LATENCY + MOCK_LATENCY_PER_REQUEST * (state["in_flight"] - 1) + random.uniform(0, MOCK_JITTER)
+        await asyncio.sleep(delay)
+    finally:
+        state["in_flight"] -= 1
+
+    words = text.split(" ")
+    token_delay = MOCK_TOKEN_DELAY
+    if replayed:
+        # Pad the answer to the recorded size and spread the recorded stream time over it
+        if data.get("stream") and MOCK_STREAM:
+            frame = len(f"data: {json.dumps(chunk('lorem '))}\n\n")
+            count = max(len(words), replayed["bytes"] // frame)
+            words += ["lorem"] * (count - len(words))
+            token_delay = max(0.0, replayed["upstream_ms"] - replayed["upstream_ttfb_ms"]) / 1000 / count
+        else:
+            text += " lorem" * max(0, (replayed["bytes"] - len(text) - 250) // 6)
+
+    if data.get("stream") and MOCK_STREAM:
+        async def stream():
+            for word in words:
+                yield f"data: {json.dumps(chunk(word + ' '))}\n\n"
+                await asyncio.sleep(token_delay)
+            yield f"data: {json.dumps(chunk('', 'stop'))}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    return {
+        "object": "chat.completion",
+        "model": data.get("model", "mock"),
+        "choices": [
+            {"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}
+        ],
+        "usage": {"prompt_tokens": len(text.split()), "completion_tokens": len(text.split())},
+    }
+
+
+@app.get("/v1/models")
+async def get_models(request: Request):
+    if request.headers.get("if-none-match") == MODELS_ETAG:
+        return Response(status_code=304, headers={"ETag": MODELS_ETAG})
+    return JSONResponse(content={"object": "list", "data": [{"id": "shapesinc/mock"}]}, headers={"ETag": MODELS_ETAG})
+
+
+@app.get("/mock/stats")
+async def get_stats():
+    return state
@@ -1,11 +1,35 @@
 import os
 import json
+import time
 import asyncio
-from fastapi import FastAPI, Request
-from fastapi.responses import StreamingResponse, JSONResponse
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import Response, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
-import httpx
+
+from cache import ModelsCache, ResponseCache, parse_ttls
+from capture import TrafficCapture
+from coalesce import Coalescer, request_key
+from metrics import ProxyMetrics, Registry
+from scheduler import AdaptiveLimit, QueueFull, RateLimiter, Scheduler, parse_weights
+from sse import (
+    HEARTBEAT,
+    ClientDisconnected,
+    EventStreamResponse,
+    Framer,
+    GuardedStream,
+    cancel_on_disconnect,
+    error_status,
+    error_stream,
+    is_event_stream,
+    relay,
+    sse_events,
+    with_heartbeats,
+)
+from state import make_state
+from upstream import Resolver, Upstream, parse_targets
+from usage import FIELDS as USAGE_FIELDS, UsageTracker, parse_quotas
 
 load_dotenv()
 
@@ -13,7 +37,232 @@ API_KEY = os.getenv("API_KEY")
 API_BASE_URL = os.getenv("BASE_URL")
 uid =os.getenv("user_id", "default")
 chid = os.getenv("channel_id", "public")
-app = FastAPI()
+
+# Upstream connection pool
+POOL_MAX_CONNECTIONS = int(os.getenv("POOL_MAX_CONNECTIONS", "100"))
+POOL_MAX_KEEPALIVE = int(os.getenv("POOL_MAX_KEEPALIVE", "20"))
+POOL_KEEPALIVE_EXPIRY = float(os.getenv("POOL_KEEPALIVE_EXPIRY", "30"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "120"))
+UPSTREAM_POOL_TIMEOUT = float(os.getenv("UPSTREAM_POOL_TIMEOUT", "10"))
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "true").lower() == "true"
+
+# Synthetic streaming for upstreams that return a plain completion
+SSE_CHUNK_POLICY = os.getenv("SSE_CHUNK_POLICY", "single")  # single, word, bytes or time
+SSE_CHUNK_BYTES = int(os.getenv("SSE_CHUNK_BYTES", "64"))
+SSE_SLICE_MS = float(os.getenv("SSE_SLICE_MS", "50"))
+SSE_CHARS_PER_SECOND = int(os.getenv("SSE_CHARS_PER_SECOND", "400"))
+SSE_PACING = os.getenv("SSE_PACING", "false").lower() == "true"
+
+# Parse passthrough (stream: false) responses to check they hold a completion
+VALIDATE_RESPONSES = os.getenv("VALIDATE_RESPONSES", "false").lower() == "true"
+
+# Seconds a /v1/models answer is fresh; stale answers are served while refreshing
+MODELS_CACHE_TTL = float(os.getenv("MODELS_CACHE_TTL", "300"))
+
+# Share one upstream call between identical concurrent completions
+COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", "false").lower() == "true"
+
+# Serve repeated and near-duplicate prompts from memory instead of calling upstream
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "false").lower() == "true"
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "300"))
+RESPONSE_CACHE_MODEL_TTLS = os.getenv("RESPONSE_CACHE_MODEL_TTLS", "")  # e.g. "shapesinc/a=60,shapesinc/b=3600"
+RESPONSE_CACHE_MAX_DISTANCE = int(os.getenv("RESPONSE_CACHE_MAX_DISTANCE", "0"))  # SimHash bits, 0 = exact only
+RESPONSE_CACHE_SHARED = os.getenv("RESPONSE_CACHE_SHARED", "false").lower() == "true"  # share across users/channels
+
+# Admission control: concurrent upstream calls (0 = no cap) and per-user fair queueing
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "64"))
+MAX_CONCURRENCY_PER_USER = int(os.getenv("MAX_CONCURRENCY_PER_USER", "0"))
+MAX_CONCURRENCY_PER_CHANNEL = int(os.getenv("MAX_CONCURRENCY_PER_CHANNEL", "0"))
+MAX_QUEUE = int(os.getenv("MAX_QUEUE", "512"))
+MAX_QUEUE_PER_USER = int(os.getenv("MAX_QUEUE_PER_USER", "32"))
+QUEUE_TIMEOUT = float(os.getenv("QUEUE_TIMEOUT", "30"))
+USER_WEIGHTS = os.getenv("USER_WEIGHTS", "")  # e.g. "alice=3,bob=1"
+
+# Let observed upstream latency and errors move MAX_CONCURRENCY between these bounds
+ADAPTIVE_CONCURRENCY = os.getenv("ADAPTIVE_CONCURRENCY", "false").lower() == "true"
+ADAPTIVE_MIN_LIMIT = int(os.getenv("ADAPTIVE_MIN_LIMIT", "4"))
+ADAPTIVE_MAX_LIMIT = int(os.getenv("ADAPTIVE_MAX_LIMIT", "256"))
+ADAPTIVE_WINDOW = int(os.getenv("ADAPTIVE_WINDOW", "20"))  # calls per RTT sample window
+ADAPTIVE_TOLERANCE = float(os.getenv("ADAPTIVE_TOLERANCE", "1.5"))  # RTT growth tolerated before shrinking
+
+# Several upstream keys/base URLs: "url|key|weight,url|key|weight" (url and weight optional)
+UPSTREAMS = os.getenv("UPSTREAMS", "")
+UPSTREAM_ROUTING = os.getenv("UPSTREAM_ROUTING", "least_outstanding")  # or weighted_round_robin
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))  # consecutive 429/5xx before ejecting a target
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))
+PROBE_INTERVAL = float(os.getenv("PROBE_INTERVAL", "10"))
+
+# Retries for connection errors and 429/503, and opt-in hedging of slow requests
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", "2"))
+UPSTREAM_DEADLINE = float(os.getenv("UPSTREAM_DEADLINE", "60"))  # seconds of retrying per request
+HEDGE_REQUESTS = os.getenv("HEDGE_REQUESTS", "false").lower() == "true"
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.5"))
+HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", "0.1"))  # max hedges as a share of upstream requests
+
+# /v1/batch: max requests per batch and max concurrent upstream calls per batch
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "10000"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+
+# Concurrent requests one /v1/ws session may have open
+WS_MAX_IN_FLIGHT = int(os.getenv("WS_MAX_IN_FLIGHT", "16"))
+
+# Seconds between SSE keep-alive comments while waiting for the first chunk (0 = wait before sending headers)
+SSE_HEARTBEAT_INTERVAL = float(os.getenv("SSE_HEARTBEAT_INTERVAL", "10"))
+
+# Startup warm-up: resolve upstream hosts and open keep-alive connections before /ready reports ready
+WARMUP_CONNECTIONS = int(os.getenv("WARMUP_CONNECTIONS", "4"))  # per HTTP/1.1 target (HTTP/2 needs one), 0 = resolve only
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "10"))
+DNS_CACHE = os.getenv("DNS_CACHE", "true").lower() == "true"
+DNS_TTL = float(os.getenv("DNS_TTL", "60"))  # seconds, when record TTLs are unknown (no dnspython)
+
+# State shared between workers: memory (single worker), shm[:path] (workers on one host) or a redis:// URL
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")
+
+# Requests per user per RATE_LIMIT_WINDOW seconds, counted across workers (0 = no limit)
+USER_RATE_LIMIT = int(os.getenv("USER_RATE_LIMIT", "0"))
+RATE_LIMIT_WINDOW = float(os.getenv("RATE_LIMIT_WINDOW", "60"))
+RATE_LIMIT_SYNC_INTERVAL = float(os.getenv("RATE_LIMIT_SYNC_INTERVAL", "0.5"))  # seconds between shared counter syncs
+
+# Per-tenant (user id) usage, flushed to USAGE_LOG: a .db/.sqlite file, or any other path for NDJSON
+USAGE_TRACKING = os.getenv("USAGE_TRACKING", "true").lower() == "true"
+USAGE_LOG = os.getenv("USAGE_LOG", "")  # empty = in memory only
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "30"))
+USAGE_QUOTA_PERIOD = float(os.getenv("USAGE_QUOTA_PERIOD", "86400"))
+USAGE_QUOTA_METRIC = os.getenv("USAGE_QUOTA_METRIC", "tokens")  # tokens, chars or any usage field; counted per worker
+USAGE_SOFT_QUOTA = float(os.getenv("USAGE_SOFT_QUOTA", "0"))  # per tenant per period, 0 = none; logged when passed
+USAGE_HARD_QUOTA = float(os.getenv("USAGE_HARD_QUOTA", "0"))  # per tenant per period, 0 = none; 429 once reached
+USAGE_QUOTAS = os.getenv("USAGE_QUOTAS", "")  # per-tenant overrides, e.g. "alice=1000:5000,bob=:200"
+USAGE_MAX_TENANTS = int(os.getenv("USAGE_MAX_TENANTS", "10000"))  # tenants kept in memory, least recently active dropped
+
+# Log every chat completion's body, timings and size to a rotating NDJSON file for replay.py
+CAPTURE_PATH = os.getenv("CAPTURE_PATH", "")  # empty = no capture
+CAPTURE_MAX_BYTES = int(os.getenv("CAPTURE_MAX_BYTES", str(50 * 1024 * 1024)))
+CAPTURE_BACKUPS = int(os.getenv("CAPTURE_BACKUPS", "3"))
+CAPTURE_REDACT = os.getenv("CAPTURE_REDACT", "true").lower() == "true"  # mask message text and ids
+CAPTURE_REDACT_KEY = os.getenv("CAPTURE_REDACT_KEY", "")  # secret for hashing; empty = random per process
+
+upstream = Upstream(
+    parse_targets(
+        UPSTREAMS,
+        API_BASE_URL,
+        API_KEY,
+        failure_threshold=BREAKER_FAILURES,
+        cooldown=BREAKER_COOLDOWN,
+    ),
+    routing=UPSTREAM_ROUTING,
+    probe_interval=PROBE_INTERVAL,
+    retries=UPSTREAM_RETRIES,
+    deadline=UPSTREAM_DEADLINE,
+    hedge=HEDGE_REQUESTS,
+    hedge_min_delay=HEDGE_MIN_DELAY,
+    hedge_budget=HEDGE_BUDGET,
+    max_connections=POOL_MAX_CONNECTIONS,
+    max_keepalive=POOL_MAX_KEEPALIVE,
+    keepalive_expiry=POOL_KEEPALIVE_EXPIRY,
+    connect_timeout=UPSTREAM_CONNECT_TIMEOUT,
+    read_timeout=UPSTREAM_READ_TIMEOUT,
+    pool_timeout=UPSTREAM_POOL_TIMEOUT,
+    http2=UPSTREAM_HTTP2,
+    resolver=Resolver(ttl=DNS_TTL) if DNS_CACHE else None,
+)
+
+framer = Framer(
+    policy=SSE_CHUNK_POLICY,
+    chunk_bytes=SSE_CHUNK_BYTES,
+    slice_seconds=SSE_SLICE_MS / 1000,
+    chars_per_second=SSE_CHARS_PER_SECOND,
+    pace=SSE_PACING,
+)
+
+metrics = ProxyMetrics(upstream)
+upstream.on_connect = metrics.connect_seconds.observe
+
+
+async def fetch_models(etag=None):
+    return await upstream.request("GET", "/v1/models", headers={"If-None-Match": etag} if etag else None)
+
+
+state = make_state(STATE_BACKEND)
+# A single worker has nothing to share, so its caches skip the extra copies
+shared_state = state if state.name != "memory" else None
+
+models_cache = ModelsCache(fetch_models, ttl=MODELS_CACHE_TTL, state=shared_state)
+coalescer = Coalescer()
+response_cache = ResponseCache(
+    max_bytes=RESPONSE_CACHE_MAX_BYTES,
+    ttl=RESPONSE_CACHE_TTL,
+    model_ttls=parse_ttls(RESPONSE_CACHE_MODEL_TTLS),
+    max_distance=RESPONSE_CACHE_MAX_DISTANCE,
+    state=shared_state,
+)
+scheduler = Scheduler(
+    max_concurrency=MAX_CONCURRENCY,
+    per_user=MAX_CONCURRENCY_PER_USER,
+    per_channel=MAX_CONCURRENCY_PER_CHANNEL,
+    max_queue=MAX_QUEUE,
+    max_queue_per_user=MAX_QUEUE_PER_USER,
+    max_wait=QUEUE_TIMEOUT,
+    weights=parse_weights(USER_WEIGHTS),
+)
+rate_limiter = None
+if USER_RATE_LIMIT > 0:
+    rate_limiter = RateLimiter(state, USER_RATE_LIMIT, window=RATE_LIMIT_WINDOW, sync_interval=RATE_LIMIT_SYNC_INTERVAL)
+usage = None
+if USAGE_TRACKING:
+    usage = UsageTracker(
+        sink=USAGE_LOG,
+        flush_interval=USAGE_FLUSH_INTERVAL,
+        period=USAGE_QUOTA_PERIOD,
+        metric=USAGE_QUOTA_METRIC,
+        soft_quota=USAGE_SOFT_QUOTA,
+        hard_quota=USAGE_HARD_QUOTA,
+        quotas=parse_quotas(USAGE_QUOTAS),
+        max_tenants=USAGE_MAX_TENANTS,
+    )
+traffic = None
+if CAPTURE_PATH:
+    traffic = TrafficCapture(
+        CAPTURE_PATH,
+        max_bytes=CAPTURE_MAX_BYTES,
+        backups=CAPTURE_BACKUPS,
+        redact=CAPTURE_REDACT,
+        redact_key=CAPTURE_REDACT_KEY,
+    )
+limiter = None
+if ADAPTIVE_CONCURRENCY:
+    limiter = AdaptiveLimit(
+        scheduler,
+        min_limit=ADAPTIVE_MIN_LIMIT,
+        max_limit=ADAPTIVE_MAX_LIMIT,
+        window=ADAPTIVE_WINDOW,
+        tolerance=ADAPTIVE_TOLERANCE,
+    )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await upstream.start()
+    # Serve while warming up; load balancers wait for /ready
+    warmup = asyncio.create_task(upstream.warm_up(WARMUP_CONNECTIONS, WARMUP_TIMEOUT))
+    if rate_limiter:
+        rate_limiter.start()
+    if usage:
+        usage.start()
+    yield
+    warmup.cancel()
+    await upstream.close()
+    if rate_limiter:
+        await rate_limiter.close()
+    if usage:
+        await usage.close()
+    await state.close()
+    if traffic:
+        traffic.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS (allow frontend)
 app.add_middleware(
@@ -24,10 +273,191 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-@app.post("/v1/chat/completions")
-async def chat_completions(request: Request):
-    data = await request.json()
+def valid_completion(body):
+    try:
+        return isinstance(json.loads(body)["choices"][0]["message"]["content"], str)
+    except Exception:
+        return False
+
+
+def upstream_first(started, capture=None):
+    seconds = time.perf_counter() - started
+    metrics.ttfb_seconds.observe(seconds)
+    if capture:
+        capture.upstream_first(seconds)
+
+
+def upstream_end(started, capture=None):
+    seconds = time.perf_counter() - started
+    metrics.upstream_seconds.observe(seconds)
+    if capture:
+        capture.upstream_end(seconds)
+
+
+async def passthrough(headers, payload, capture=None):
+    # Non-streaming callers get the upstream body byte for byte, no SSE and no re-encoding
+    started = time.perf_counter()
+    try:
+        r = await upstream.send("POST", "/v1/chat/completions", headers=headers, json=payload)
+    except Exception as e:
+        metrics.errors.inc(type(e).__name__)
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+    upstream_first(started, capture)
+
+    try:
+        await r.aread()
+    except Exception as e:
+        metrics.errors.inc(type(e).__name__)
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+    finally:
+        await upstream.release(r)
+        upstream_end(started, capture)
+
+    if r.status_code == 200 and VALIDATE_RESPONSES and not valid_completion(r.content):
+        return JSONResponse(content={"error": "Invalid response format"}, status_code=502)
+
+    return Response(
+        content=r.content,
+        status_code=r.status_code,
+        media_type=r.headers.get("content-type", "application/json"),
+    )
+
+
+async def start_stream(headers, payload, capture=None):
+    # Ask the Shapes API to stream and forward its SSE chunks as they arrive
+    started = time.perf_counter()
+    try:
+        r = await upstream.send(
+            "POST",
+            "/v1/chat/completions",
+            headers=headers,
+            json={**payload, "stream": True},
+        )
+    except Exception as e:
+        metrics.errors.inc(type(e).__name__)
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+
+    if r.status_code != 200:
+        try:
+            error = (await r.aread()).decode(errors="replace")
+        except Exception as e:
+            error = str(e)
+        finally:
+            await upstream.release(r)
+            upstream_end(started, capture)
+        return JSONResponse(content={"error": error}, status_code=r.status_code)
+
+    if is_event_stream(r):
+        async def finish():
+            await upstream.release(r)
+            upstream_end(started, capture)
+
+        return GuardedStream(
+            relay(r),
+            cleanup=finish,
+            on_first=lambda: upstream_first(started, capture),
+        )
+
+    # Upstream answered with a plain completion, frame it as a synthetic stream
+    upstream_first(started, capture)
+    try:
+        await r.aread()
+        completion = r.json()["choices"][0]["message"]["content"]
+    except Exception as e:
+        metrics.errors.inc(type(e).__name__)
+        return JSONResponse(content={"error": "Invalid response format"}, status_code=500)
+    finally:
+        await upstream.release(r)
+        upstream_end(started, capture)
+
+    return framer.stream(completion)
+
+
+async def admitted(user_id, channel_id, call, prompt="", accepted=None):
+    # Hold a scheduler slot for the whole upstream call, including the stream body.
+    # `accepted` is called once the request is running or queued, past every fast rejection.
+    try:
+        if rate_limiter:
+            rate_limiter.check(user_id)
+        if usage:
+            usage.check(user_id)
+        ticket = await scheduler.acquire(user_id, channel_id, accepted)
+    except BaseException:
+        call.close()
+        raise
+    started = time.monotonic()
+    account = usage.begin(user_id, prompt) if usage else None
+    try:
+        result = await call
+    except asyncio.CancelledError:
+        # The client left or the batch stopped; says nothing about upstream health
+        scheduler.release(ticket)
+        if account:
+            account.finish(499)
+        raise
+    except BaseException:
+        scheduler.release(ticket)
+        if limiter:
+            limiter.record(time.monotonic() - started, ok=False)
+        if account:
+            account.finish(500)
+        raise
+
+    if limiter:
+        status = result.status_code if isinstance(result, Response) else 200
+        limiter.record(time.monotonic() - started, ok=status != 429 and status < 500)
+
+    if isinstance(result, Response):
+        scheduler.release(ticket)
+        if account:
+            account.finish(result.status_code, result.body)
+        return result
+
+    def finish():
+        scheduler.release(ticket)
+        if account:
+            account.finish(200)
+
+    return GuardedStream(result, cleanup=finish, on_chunk=account.chunk if account else None)
+
+
+def instrumented(result, model, capture=None):
+    # The status line went out as 200, so the status recorded is the in-band error's code,
+    # or 499 when the client leaves before the stream ends
+    first = []
+    outcome = {"status": 200}
+
+    def finish():
+        if first:
+            metrics.stream_seconds.observe(time.perf_counter() - first[0])
+        metrics.requests.inc(str(outcome["status"]), model)
+        metrics.in_flight.dec()
+        if capture:
+            capture.finish(outcome["status"])
+
+    def chunk(chunk):
+        status = error_status(chunk)
+        if status is not None:
+            outcome["status"] = status
+        if capture:
+            if chunk is not HEARTBEAT:
+                capture.first()
+            capture.add(len(chunk))
+
+    def disconnected():
+        outcome["status"] = 499
+        metrics.disconnects.inc("streaming")
 
+    stream = GuardedStream(
+        result,
+        cleanup=finish,
+        on_first=lambda: first.append(time.perf_counter()),
+        on_chunk=chunk,
+    )
+    return EventStreamResponse(stream, on_disconnect=disconnected)
+
+
+def completion_request(data, user_id, channel_id):
     user_text = ""
     for msg in data.get("messages", []):
         if msg.get("role") == "user":
@@ -35,58 +465,425 @@ async def chat_completions(request: Request):
             break
 
     model = data.get("model", "shapesinc/beta-1q75")
+    headers = {
+        "Content-Type": "application/json",
+        "X-User-Id": user_id,
+        "X-Channel-Id": channel_id
+    }
+    payload = {
+        "model": model,
+        "messages": [{"role": "user", "content": user_text}],
+    }
+    return model, user_text, headers, payload
 
-    # Send real POST request to Shapes API (non-stream)
-    async with httpx.AsyncClient() as client:
-        try:
-            r = await client.post(
-                f"{API_BASE_URL}/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {API_KEY}",
-                    "Content-Type": "application/json",
-                    "X-User-Id": uid,
-        		    "X-Channel-Id": chid
-                },
-                json={
-                    "model": model,
-                    "messages": [{"role": "user", "content": user_text}],
-                }
-            )
-        except Exception as e:
-            return JSONResponse(content={"error": str(e)}, status_code=500)
 
-    if r.status_code != 200:
-        return JSONResponse(content={"error": r.text}, status_code=r.status_code)
+async def recorded(source, store):
+    chunks = []
+    failed = False
+    async for chunk in source:
+        chunks.append(chunk)
+        failed = failed or error_status(chunk) is not None
+        yield chunk
+    body = b"".join(chunks)
+    # Only keep complete answers; a stream cut short by upstream ends with an error event
+    if not failed and body.rstrip().endswith(b"[DONE]"):
+        store(body)
+
+
+async def cached(call, scope, model, user_text):
+    # Keep successful answers for later near-duplicate prompts
+    result = await call()
+    if isinstance(result, Response):
+        if result.status_code == 200:
+            response_cache.put(scope, model, user_text, result.body, result.media_type)
+        return result
+
+    def store(body):
+        response_cache.put(scope, model, user_text, body, "text/event-stream")
+
+    return GuardedStream(recorded(result, store), cleanup=result.aclose)
+
 
+async def opening(work):
+    # Turn a pending completion into a byte stream, reporting failures as SSE error events
     try:
-        completion = r.json()["choices"][0]["message"]["content"]
+        result = await work
+    except QueueFull as e:
+        metrics.errors.inc("QueueFull")
+        return error_stream(429, str(e))
+    if not isinstance(result, Response):
+        return result
+    try:
+        message = json.loads(result.body)["error"]
     except Exception:
-        return JSONResponse(content={"error": "Invalid response format"}, status_code=500)
+        message = result.body.decode(errors="replace")
+    return error_stream(result.status_code, message)
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    started = time.perf_counter()
+    data = await request.json()
+
+    user_id = request.headers.get("X-User-Id") or uid
+    channel_id = request.headers.get("X-Channel-Id") or chid
+    model, user_text, headers, payload = completion_request(data, user_id, channel_id)
+    stream = data.get("stream") is not False
+    metrics.parse_seconds.observe(time.perf_counter() - started)
+    capture = traffic.begin(data, user_id, channel_id) if traffic else None
+
+    if RESPONSE_CACHE:
+        scope = (model, stream) if RESPONSE_CACHE_SHARED else (model, user_id, channel_id, stream)
+        hit = await response_cache.get(scope, user_text)
+        if hit is not None:
+            metrics.requests.inc("200", model)
+            if capture:
+                capture.finish(200, len(hit.body), cached=True)
+            return Response(content=hit.body, media_type=hit.content_type)
+
+    metrics.in_flight.inc()
+
+    heartbeats = stream and SSE_HEARTBEAT_INTERVAL > 0
+    accepted = None
+    if heartbeats:
+        # Resolved once the request is running or queued; rejections before that still get a real 429
+        admission = asyncio.get_running_loop().create_future()
+
+        def accepted():
+            if not admission.done():
+                admission.set_result(None)
+
+    if stream:
+        call = lambda: admitted(user_id, channel_id, start_stream(headers, payload, capture), user_text, accepted)
+    else:
+        call = lambda: admitted(user_id, channel_id, passthrough(headers, payload, capture), user_text)
+
+    if RESPONSE_CACHE:
+        fetch = call
+        call = lambda: cached(fetch, scope, model, user_text)
+
+    if COALESCE_REQUESTS:
+        work = coalescer.run(request_key(model, user_id, channel_id, user_text, stream), call, on_join=accepted)
+    else:
+        work = call()
+
+    if heartbeats:
+        work = asyncio.ensure_future(work)
+        await asyncio.wait({work, admission}, return_when=asyncio.FIRST_COMPLETED)
+        if not work.done():
+            # Send headers now and keep the connection warm until upstream answers
+            return instrumented(with_heartbeats(opening(work), SSE_HEARTBEAT_INTERVAL), model, capture)
+
+    try:
+        result = await cancel_on_disconnect(request.receive, work)
+    except ClientDisconnected:
+        # Client left before the response started; its upstream call was cancelled
+        metrics.disconnects.inc("waiting")
+        metrics.requests.inc("499", model)
+        metrics.in_flight.dec()
+        if capture:
+            capture.finish(499, 0)
+        return Response(status_code=499)
+    except QueueFull as e:
+        metrics.errors.inc("QueueFull")
+        metrics.requests.inc("429", model)
+        metrics.in_flight.dec()
+        if capture:
+            capture.finish(429, 0)
+        return JSONResponse(
+            content={"error": str(e)},
+            status_code=429,
+            headers={"Retry-After": str(e.retry_after)},
+        )
+    except BaseException:
+        metrics.in_flight.dec()
+        raise
+
+    if isinstance(result, Response):
+        metrics.requests.inc(str(result.status_code), model)
+        metrics.in_flight.dec()
+        if capture:
+            capture.finish(result.status_code, len(result.body))
+        return result
+    return instrumented(result, model, capture)
+
+
+def parse_batch(body, content_type):
+    # NDJSON uploads are one request per line; anything else is a JSON array or {"requests": [...]}
+    if "ndjson" in content_type or "jsonl" in content_type:
+        items = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError as e:
+                items.append(ValueError(f"Invalid JSON: {e}"))
+        return items
+
+    data = json.loads(body)
+    if isinstance(data, dict):
+        data = data.get("requests")
+    if not isinstance(data, list):
+        raise ValueError("Expected a JSON array of chat completion requests")
+    return data
+
+
+def batch_line(index, status, body=None, content_type="", error=None):
+    if error is None and body and content_type.startswith("application/json"):
+        body = body.strip()
+        if b"\n" in body or b"\r" in body:
+            # Pretty-printed JSON would break the one-result-per-line framing
+            try:
+                body = json.dumps(json.loads(body), separators=(",", ":")).encode()
+            except ValueError:
+                error = body.decode(errors="replace")
+        if error is None:
+            # Splice the upstream JSON in as-is instead of parsing and re-encoding it
+            return b'{"index":%d,"status":%d,"response":%s}\n' % (index, status, body)
+    if error is None:
+        error = body.decode(errors="replace") if body else ""
+    return (json.dumps({"index": index, "status": status, "error": error}) + "\n").encode()
+
+
+async def batch_item(index, item, user_id, channel_id):
+    if isinstance(item, Exception):
+        return batch_line(index, 400, error=str(item))
+    if not isinstance(item, dict):
+        return batch_line(index, 400, error="Expected a chat completion request object")
+
+    model, user_text, headers, payload = completion_request(item, user_id, channel_id)
+    try:
+        result = await admitted(user_id, channel_id, passthrough(headers, payload), user_text)
+    except QueueFull as e:
+        metrics.requests.inc("429", model)
+        return batch_line(index, 429, error=str(e))
+    except Exception as e:
+        metrics.errors.inc(type(e).__name__)
+        metrics.requests.inc("500", model)
+        return batch_line(index, 500, error=str(e))
 
-    # emulate streaming character-by-character
-    async def fake_stream():
-        for char in completion:
-            chunk = {
-                "choices": [
-                    {
-                        "delta": {"content": char},
-                        "finish_reason": None,
-                    }
-                ]
-            }
-            yield f"data: {json.dumps(chunk)}\n\n"
-            await asyncio.sleep(0.01)
-        # end of stream
-        yield "data: [DONE]\n\n"
-
-    return StreamingResponse(fake_stream(), media_type="text/event-stream")
+    metrics.requests.inc(str(result.status_code), model)
+    return batch_line(index, result.status_code, result.body, result.media_type or "")
+
+
+def run_batch(items, user_id, channel_id, concurrency):
+    # A fixed set of workers pulls items in order; results stream out as they complete
+    results = asyncio.Queue()
+    pending = enumerate(items)
+    workers = []
+
+    async def worker():
+        for index, item in pending:
+            await results.put(await batch_item(index, item, user_id, channel_id))
+
+    async def lines():
+        workers.extend(asyncio.create_task(worker()) for _ in range(min(concurrency, len(items))))
+        done = asyncio.gather(*workers)
+        while not done.done() or not results.empty():
+            getter = asyncio.ensure_future(results.get())
+            await asyncio.wait({getter, done}, return_when=asyncio.FIRST_COMPLETED)
+            if getter.done():
+                yield getter.result()
+            else:
+                getter.cancel()
+        done.result()
+
+    def stop():
+        for task in workers:
+            task.cancel()
+
+    return GuardedStream(lines(), cleanup=stop)
+
+
+@app.post("/v1/batch")
+async def batch(request: Request):
+    try:
+        items = parse_batch(await request.body(), request.headers.get("content-type", ""))
+    except ValueError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+    if len(items) > BATCH_MAX_ITEMS:
+        return JSONResponse(content={"error": f"Batch is limited to {BATCH_MAX_ITEMS} requests"}, status_code=413)
+
+    try:
+        concurrency = int(request.query_params.get("concurrency", BATCH_CONCURRENCY))
+    except ValueError:
+        return JSONResponse(content={"error": "concurrency must be an integer"}, status_code=400)
+    concurrency = max(1, min(concurrency, BATCH_CONCURRENCY))
+
+    user_id = request.headers.get("X-User-Id") or uid
+    channel_id = request.headers.get("X-Channel-Id") or chid
+    return EventStreamResponse(
+        run_batch(items, user_id, channel_id, concurrency),
+        on_disconnect=lambda: metrics.disconnects.inc("batch"),
+        media_type="application/x-ndjson",
+    )
+
+
+def ws_frame(request_id, field, payload):
+    # Splice upstream JSON into the frame instead of parsing and re-encoding it
+    return '{"id":%s,"%s":%s}' % (json.dumps(request_id), field, payload.decode())
+
+
+def ws_error(request_id, status, message, **extra):
+    return json.dumps({"id": request_id, "error": {"message": message, "code": status, **extra}})
+
+
+async def ws_completion(send, request_id, data, user_id, channel_id):
+    model, user_text, headers, payload = completion_request(data, user_id, channel_id)
+    stream = data.get("stream") is not False
+    metrics.in_flight.inc()
+    status = 200
+
+    if stream:
+        call = lambda: admitted(user_id, channel_id, start_stream(headers, payload), user_text)
+    else:
+        call = lambda: admitted(user_id, channel_id, passthrough(headers, payload), user_text)
+
+    try:
+        if COALESCE_REQUESTS:
+            result = await coalescer.run(request_key(model, user_id, channel_id, user_text, stream), call)
+        else:
+            result = await call()
+
+        if isinstance(result, Response):
+            status = result.status_code
+            if status == 200:
+                await send(ws_frame(request_id, "response", result.body))
+            else:
+                try:
+                    message = json.loads(result.body)["error"]
+                except Exception:
+                    message = result.body.decode(errors="replace")
+                await send(ws_error(request_id, status, message))
+            return
+
+        try:
+            async for event in sse_events(result):
+                await send(ws_frame(request_id, "chunk", event))
+        finally:
+            await result.aclose()
+        await send(json.dumps({"id": request_id, "done": True}))
+    except QueueFull as e:
+        status = 429
+        metrics.errors.inc("QueueFull")
+        await send(ws_error(request_id, 429, str(e), retry_after=e.retry_after))
+    except asyncio.CancelledError:
+        status = 499
+        raise
+    except Exception as e:
+        # Usually the socket closing under us; the session cleans up the rest
+        status = 500
+        metrics.errors.inc(type(e).__name__)
+    finally:
+        metrics.requests.inc(str(status), model)
+        metrics.in_flight.dec()
+
+
+@app.websocket("/v1/ws")
+async def chat_socket(websocket: WebSocket):
+    # One socket per session; requests carry an "id" and run concurrently
+    await websocket.accept()
+    session = {
+        "user_id": websocket.query_params.get("user_id") or websocket.headers.get("X-User-Id") or uid,
+        "channel_id": websocket.query_params.get("channel_id") or websocket.headers.get("X-Channel-Id") or chid,
+    }
+    lock = asyncio.Lock()
+    tasks = {}
+
+    async def send(text):
+        async with lock:
+            await websocket.send_text(text)
+
+    metrics.ws_sessions.inc()
+    try:
+        while True:
+            try:
+                message = json.loads(await websocket.receive_text())
+            except WebSocketDisconnect:
+                break
+            except (ValueError, KeyError):
+                await send(ws_error(None, 400, "Frames must be JSON text"))
+                continue
+            if not isinstance(message, dict):
+                await send(ws_error(None, 400, "Frames must be JSON objects"))
+                continue
+
+            kind = message.get("type", "chat")
+            request_id = message.get("id")
+            if request_id is not None and (not isinstance(request_id, (str, int)) or isinstance(request_id, bool)):
+                await send(ws_error(None, 400, "Request ids must be strings or integers"))
+                continue
+            if kind == "session":
+                session["user_id"] = message.get("user_id") or session["user_id"]
+                session["channel_id"] = message.get("channel_id") or session["channel_id"]
+                await send(json.dumps({"type": "session", **session}))
+            elif kind == "cancel":
+                if request_id in tasks:
+                    tasks[request_id].cancel()
+            elif request_id is None or request_id in tasks:
+                await send(ws_error(request_id, 400, "Each request needs an id not already in use"))
+            elif len(tasks) >= WS_MAX_IN_FLIGHT:
+                await send(ws_error(request_id, 429, "Too many requests in flight on this session"))
+            else:
+                task = asyncio.create_task(
+                    ws_completion(send, request_id, message, session["user_id"], session["channel_id"])
+                )
+                tasks[request_id] = task
+                task.add_done_callback(lambda _, request_id=request_id: tasks.pop(request_id, None))
+    finally:
+        metrics.ws_sessions.dec()
+        pending = list(tasks.values())
+        if pending:
+            metrics.disconnects.inc("websocket")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
 
 
 @app.get("/v1/models")
 async def get_models():
-    async with httpx.AsyncClient() as client:
-        r = await client.get(
-            f"{API_BASE_URL}/v1/models",
-            headers={"Authorization": f"Bearer {API_KEY}"}
-        )
-        return JSONResponse(content=r.json(), status_code=r.status_code)
+    try:
+        cached = await models_cache.get()
+    except Exception as e:
+        return JSONResponse(content={"error": str(e)}, status_code=500)
+    return Response(content=cached.body, status_code=cached.status_code, media_type=cached.content_type)
+
+
+@app.get("/usage")
+async def get_usage(top: int = 10, by: str = "tokens", period: str = "all"):
+    # Biggest consumers since startup, or in the current quota period with ?period=current
+    if not usage:
+        return JSONResponse(content={"error": "Usage tracking is off (USAGE_TRACKING=false)"}, status_code=404)
+    if by not in ("tokens", "chars") + USAGE_FIELDS:
+        return JSONResponse(content={"error": f"Unknown usage metric {by!r}"}, status_code=400)
+    return {"by": by, "period": period, "top": usage.top(top, by, current=period == "current")}
+
+
+@app.get("/ready")
+async def get_ready():
+    if not upstream.ready:
+        return JSONResponse(content={"ready": False}, status_code=503)
+    return {"ready": True, "warmup": upstream.warmup}
+
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(content=metrics.render(), media_type=Registry.CONTENT_TYPE)
+
+
+@app.get("/stats")
+async def get_stats():
+    return {
+        "pool": upstream.pool_stats(),
+        "models_cache": models_cache.stats(),
+        "coalescing": coalescer.stats() if COALESCE_REQUESTS else None,
+        "response_cache": response_cache.stats() if RESPONSE_CACHE else None,
+        "scheduler": scheduler.stats(),
+        "adaptive_limit": limiter.stats() if limiter else None,
+        "rate_limit": rate_limiter.stats() if rate_limiter else None,
+        "usage": usage.stats() if usage else None,
+        "state": state.stats(),
+        "capture": traffic.stats() if traffic else None,
+        "client_disconnects": {phase: count for (phase,), count in metrics.disconnects.values.items()},
+    }
@@ -0,0 +1,115 @@
+"""
+Replays a traffic capture (CAPTURE_PATH) against a running proxy.
+
+Requests are sent in their recorded order, with their recorded gaps divided
+by --speed, or as fast as --concurrency allows with --speed max. Point the
+proxy at mock_upstream.py started with MOCK_CAPTURE set to the same files so
+every request gets its recorded upstream latency and response size back, and
+the run is repeatable:
+
+    MOCK_CAPTURE=capture.log python -m uvicorn mock_upstream:app --port 9001
+    BASE_URL=http://127.0.0.1:9001 python -m uvicorn proxy:app --port 8000
+    python replay.py capture.log capture.log.1 --speed 10
+
+Reports throughput and time-to-first-byte and total latency percentiles, next
+to the percentiles recorded in the capture.
+
+Usage:
+    python replay.py CAPTURE [CAPTURE ...] [--url http://127.0.0.1:8000] [--speed 1|10|max] [--concurrency 256]
+"""
+
+import time
+import asyncio
+import argparse
+
+import httpx
+
+from capture import read_capture
+from sse import HEARTBEAT
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def summary(label, values):
+    return (
+        f"{label:<18} p50 {percentile(values, 50):8.1f}  p90 {percentile(values, 90):8.1f}  "
+        f"p99 {percentile(values, 99):8.1f}  max {percentile(values, 100):8.1f} ms"
+    )
+
+
+async def send(client, url, record, semaphore, results):
+    headers = {"X-User-Id": str(record.get("user")), "X-Channel-Id": str(record.get("channel"))}
+    async with semaphore:
+        started = time.perf_counter()
+        first = None
+        size = 0
+        try:
+            async with client.stream("POST", f"{url}/v1/chat/completions", json=record["body"], headers=headers) as r:
+                async for chunk in r.aiter_raw():
+                    if first is None and chunk != HEARTBEAT:
+                        first = time.perf_counter()
+                    size += len(chunk)
+                status = r.status_code
+        except httpx.HTTPError as e:
+            status = type(e).__name__
+        ended = time.perf_counter()
+    results.append({
+        "status": status,
+        "ttfb_ms": ((first or ended) - started) * 1000,
+        "ms": (ended - started) * 1000,
+        "bytes": size,
+    })
+
+
+async def replay(records, url, speed, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    results = []
+    tasks = []
+    async with httpx.AsyncClient(timeout=None, limits=httpx.Limits(max_connections=concurrency)) as client:
+        started = time.perf_counter()
+        t0 = records[0]["t"]
+        for record in records:
+            if speed:
+                delay = (record["t"] - t0) / speed - (time.perf_counter() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(send(client, url, record, semaphore, results)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+    return results, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("captures", nargs="+", help="capture files, rotated backups included")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="proxy to replay against")
+    parser.add_argument("--speed", default="1", help="time compression factor (1, 10, ...) or max")
+    parser.add_argument("--concurrency", type=int, default=256, help="max requests in flight")
+    args = parser.parse_args()
+
+    records = read_capture(args.captures)
+    if not records:
+        parser.error("capture holds no requests")
+    speed = None if args.speed == "max" else float(args.speed)
+
+    results, elapsed = asyncio.run(replay(records, args.url.rstrip("/"), speed, args.concurrency))
+
+    ok = [r for r in results if r["status"] == 200]
+    recorded_span = records[-1]["t"] - records[0]["t"]
+    print(f"requests:          {len(results)} ({len(results) - len(ok)} failed)")
+    print(f"speed:             {'max' if speed is None else f'{speed:g}x'}, recorded span {recorded_span:.1f} s")
+    print(f"elapsed:           {elapsed:.2f} s")
+    print(f"throughput:        {len(results) / elapsed:.1f} req/s, {sum(r['bytes'] for r in results) / elapsed / 1024:.1f} KiB/s")
+    print(summary("ttfb:", [r["ttfb_ms"] for r in ok]))
+    print(summary("total:", [r["ms"] for r in ok]))
+    print(summary("recorded ttfb:", [r["ttfb_ms"] for r in records if r.get("status") == 200]))
+    print(summary("recorded total:", [r["ms"] for r in records if r.get("status") == 200]))
+
+
+if __name__ == "__main__":
+    main()
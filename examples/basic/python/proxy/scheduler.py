@@ -0,0 +1,375 @@
+import math
+import time
+import asyncio
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """Raised when a request cannot be admitted; carries a Retry-After hint in seconds."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+class Ticket:
+    def __init__(self, user, channel):
+        self.user = user
+        self.channel = channel
+        self.admitted_at = time.monotonic()
+
+
+class _Waiter:
+    def __init__(self, user, channel, tag):
+        self.user = user
+        self.channel = channel
+        self.tag = tag
+        self.enqueued_at = time.monotonic()
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class _Tenant:
+    def __init__(self, weight):
+        self.weight = weight
+        self.queue = deque()
+        self.active = 0
+        self.finish = 0.0
+
+
+def parse_weights(spec):
+    # "alice=3,bob=1" -> {"alice": 3.0, "bob": 1.0}
+    weights = {}
+    for item in (spec or "").split(","):
+        if "=" in item:
+            name, weight = item.split("=", 1)
+            weights[name.strip()] = float(weight)
+    return weights
+
+
+class Scheduler:
+    """Admission control for upstream calls with weighted fair queueing per user.
+
+    A request runs right away when the global, per-user and per-channel caps
+    allow it (0 means no cap). Otherwise it waits in its user's queue, and
+    freed slots go to the eligible queue head with the smallest virtual finish
+    tag, so each user gets a share of the upstream proportional to its weight.
+    Full queues and waits longer than `max_wait` raise QueueFull.
+    """
+
+    def __init__(
+        self,
+        max_concurrency=64,
+        per_user=0,
+        per_channel=0,
+        max_queue=512,
+        max_queue_per_user=32,
+        max_wait=30.0,
+        weights=None,
+    ):
+        self.max_concurrency = max_concurrency
+        self.per_user = per_user
+        self.per_channel = per_channel
+        self.max_queue = max_queue
+        self.max_queue_per_user = max_queue_per_user
+        self.max_wait = max_wait
+        self.weights = weights or {}
+        self.tenants = {}
+        self.channels = {}
+        self.active = 0
+        self.queued = 0
+        self.vtime = 0.0
+        self.avg_hold = 1.0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _tenant(self, user):
+        tenant = self.tenants.get(user)
+        if tenant is None:
+            tenant = self.tenants[user] = _Tenant(self.weights.get(user, 1.0))
+        return tenant
+
+    def _can_run(self, user, channel):
+        if self.max_concurrency and self.active >= self.max_concurrency:
+            return False
+        if self.per_user and self._tenant(user).active >= self.per_user:
+            return False
+        if self.per_channel and self.channels.get(channel, 0) >= self.per_channel:
+            return False
+        return True
+
+    def _start(self, user, channel, waited=0.0):
+        self.active += 1
+        self._tenant(user).active += 1
+        self.channels[channel] = self.channels.get(channel, 0) + 1
+        self.admitted += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        return Ticket(user, channel)
+
+    def set_limit(self, limit):
+        self.max_concurrency = limit
+        self._dispatch()
+
+    def retry_after(self):
+        slots = self.max_concurrency or max(1, self.active)
+        return max(1, min(60, math.ceil((self.queued + 1) * self.avg_hold / slots)))
+
+    async def acquire(self, user, channel, accepted=None):
+        # `accepted` is called once the request runs or waits in the queue, i.e. was not rejected outright
+        tenant = self._tenant(user)
+        if not tenant.queue and self._can_run(user, channel):
+            if accepted:
+                accepted()
+            return self._start(user, channel)
+
+        if self.queued >= self.max_queue or len(tenant.queue) >= self.max_queue_per_user:
+            self.rejected += 1
+            self._cleanup(user)
+            raise QueueFull("Too many queued requests", self.retry_after())
+
+        tenant.finish = max(self.vtime, tenant.finish) + 1.0 / tenant.weight
+        waiter = _Waiter(user, channel, tenant.finish)
+        tenant.queue.append(waiter)
+        self.queued += 1
+        if accepted:
+            accepted()
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(waiter.future), self.max_wait)
+        except asyncio.TimeoutError:
+            if waiter.future.done():
+                return waiter.future.result()
+            self._drop(waiter)
+            self.timed_out += 1
+            raise QueueFull("Timed out waiting for an upstream slot", self.retry_after())
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                self.release(waiter.future.result())
+            else:
+                self._drop(waiter)
+            raise
+
+    def _drop(self, waiter):
+        tenant = self.tenants.get(waiter.user)
+        if tenant and waiter in tenant.queue:
+            tenant.queue.remove(waiter)
+            self.queued -= 1
+        waiter.future.cancel()
+        self._cleanup(waiter.user)
+        self._dispatch()
+
+    def release(self, ticket):
+        self.active -= 1
+        tenant = self.tenants.get(ticket.user)
+        if tenant:
+            tenant.active -= 1
+        count = self.channels.get(ticket.channel, 1) - 1
+        if count:
+            self.channels[ticket.channel] = count
+        else:
+            self.channels.pop(ticket.channel, None)
+        held = time.monotonic() - ticket.admitted_at
+        self.avg_hold = 0.9 * self.avg_hold + 0.1 * held
+        self._cleanup(ticket.user)
+        self._dispatch()
+
+    def _cleanup(self, user):
+        tenant = self.tenants.get(user)
+        if tenant and not tenant.queue and not tenant.active:
+            del self.tenants[user]
+
+    def _dispatch(self):
+        while self.queued:
+            best = None
+            for tenant in self.tenants.values():
+                if not tenant.queue:
+                    continue
+                head = tenant.queue[0]
+                if not self._can_run(head.user, head.channel):
+                    continue
+                if best is None or head.tag < best.tag:
+                    best = head
+            if best is None:
+                return
+
+            self.tenants[best.user].queue.popleft()
+            self.queued -= 1
+            self.vtime = best.tag
+            ticket = self._start(best.user, best.channel, time.monotonic() - best.enqueued_at)
+            best.future.set_result(ticket)
+
+    def stats(self):
+        busiest = sorted(self.tenants.items(), key=lambda kv: len(kv[1].queue), reverse=True)[:10]
+        return {
+            "active": self.active,
+            "max_concurrency": self.max_concurrency,
+            "queue_depth": self.queued,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "wait_avg_ms": round(self.wait_total / self.admitted * 1000, 3) if self.admitted else 0.0,
+            "wait_max_ms": round(self.wait_max * 1000, 3),
+            "tenants": {
+                user: {"active": tenant.active, "queued": len(tenant.queue), "weight": tenant.weight}
+                for user, tenant in busiest
+            },
+        }
+
+
+class AdaptiveLimit:
+    """Gradient-style controller for the scheduler's global concurrency cap.
+
+    RTT samples are averaged per window of `window` calls and compared with
+    a baseline RTT, the lowest window average seen, allowed to drift up
+    slowly. While latency stays near the baseline the limit grows by about
+    sqrt(limit) per window. When latency rises, the limit shrinks in
+    proportion to the slowdown, and a 429/5xx or failed call cuts it by
+    `backoff`. As in AIMD, that cut happens at most once per round trip:
+    failures of calls that started before the last cut were sent under the
+    old limit and are not counted again.
+    """
+
+    def __init__(self, scheduler, min_limit=4, max_limit=256, window=20, tolerance=1.5, smoothing=0.2, backoff=0.9):
+        self.scheduler = scheduler
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.window = window
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.backoff = backoff
+        self.limit = float(min(max(scheduler.max_concurrency or max_limit, min_limit), max_limit))
+        self.baseline = None
+        self.samples = []
+        self.errors = 0
+        self.backoffs = 0
+        self.last_backoff = float("-inf")
+        self.adjustments = 0
+        self.scheduler.set_limit(int(self.limit))
+
+    def record(self, rtt, ok=True):
+        if not ok:
+            self.errors += 1
+            now = time.monotonic()
+            if now - rtt >= self.last_backoff:
+                self.last_backoff = now
+                self.backoffs += 1
+                self._update(self.limit * self.backoff)
+            return
+
+        self.samples.append(rtt)
+        if len(self.samples) < self.window:
+            return
+        short = sum(self.samples) / len(self.samples)
+        self.samples.clear()
+
+        if self.baseline is None:
+            self.baseline = short
+        else:
+            self.baseline = min(short, self.baseline * 1.01)
+
+        gradient = max(0.5, min(1.0, self.tolerance * self.baseline / short))
+        target = self.limit * gradient + math.sqrt(self.limit)
+        self._update((1 - self.smoothing) * self.limit + self.smoothing * target)
+
+    def _update(self, limit):
+        self.limit = min(max(limit, self.min_limit), self.max_limit)
+        if int(self.limit) != self.scheduler.max_concurrency:
+            self.adjustments += 1
+            self.scheduler.set_limit(int(self.limit))
+
+    def stats(self):
+        return {
+            "limit": int(self.limit),
+            "min_limit": self.min_limit,
+            "max_limit": self.max_limit,
+            "baseline_rtt_ms": round(self.baseline * 1000, 3) if self.baseline else None,
+            "errors": self.errors,
+            "backoffs": self.backoffs,
+            "adjustments": self.adjustments,
+            "shed": self.scheduler.rejected + self.scheduler.timed_out,
+        }
+
+
+class _Window:
+    def __init__(self, window_id):
+        self.window_id = window_id
+        self.shared = 0
+        self.pending = 0
+
+
+class RateLimiter:
+    """Per-user request rate limit over fixed windows, counted across workers.
+
+    Each worker counts admissions locally and, every `sync_interval` seconds,
+    adds its new counts to a shared counter in `state` and reads back the
+    total. Decisions use the last shared total plus local counts, so no
+    request waits on the shared state, at the price of letting a few extra
+    requests through between syncs.
+    """
+
+    def __init__(self, state, limit, window=60.0, sync_interval=0.5):
+        self.state = state
+        self.limit = limit
+        self.window = window
+        self.sync_interval = sync_interval
+        self.users = {}
+        self.limited = 0
+        self.sync_errors = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._sync_loop())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await self._sync()
+
+    def check(self, user):
+        now = time.time()
+        window_id = int(now // self.window)
+        counts = self.users.get(user)
+        if counts is None or counts.window_id != window_id:
+            counts = self.users[user] = _Window(window_id)
+        if counts.shared + counts.pending >= self.limit:
+            self.limited += 1
+            raise QueueFull("Rate limit exceeded", max(1, math.ceil((window_id + 1) * self.window - now)))
+        counts.pending += 1
+
+    async def _sync_loop(self):
+        while True:
+            await asyncio.sleep(self.sync_interval)
+            await self._sync()
+
+    async def _sync(self):
+        window_id = int(time.time() // self.window)
+        for user, counts in list(self.users.items()):
+            if counts.window_id != window_id:
+                # Old window; its counts no longer matter
+                if self.users.get(user) is counts:
+                    del self.users[user]
+                continue
+            sent = counts.pending
+            try:
+                counts.shared = await self.state.incr(f"rate:{user}:{window_id}", sent, self.window * 2)
+            except Exception as e:
+                self.sync_errors += 1
+                logger.warning(f"Rate limit sync failed: {e}")
+                continue
+            counts.pending -= sent
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "window": self.window,
+            "users": len(self.users),
+            "limited": self.limited,
+            "sync_errors": self.sync_errors,
+        }
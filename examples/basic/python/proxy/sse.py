@@ -0,0 +1,338 @@
+import re
+import json
+import asyncio
+import inspect
+import logging
+
+import httpx
+from starlette.responses import StreamingResponse
+
+logger = logging.getLogger(__name__)
+
+DONE = b"data: [DONE]\n\n"
+HEARTBEAT = b": keep-alive\n\n"
+ERROR_PREFIX = b'data: {"error":'
+
+CHUNK_POLICIES = ("single", "word", "bytes", "time")
+
+# Flush coalesced frames once this many bytes are buffered
+FLUSH_BYTES = 16 * 1024
+
+_SENTINEL = "__CONTENT__"
+_WORD = re.compile(r"\S+\s*|\s+")
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def cancel_on_disconnect(receive, awaitable):
+    """Await `awaitable`, cancelling it and raising ClientDisconnected if the client goes away first."""
+    task = asyncio.ensure_future(awaitable)
+    watcher = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        done, _ = await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+        if not task.done():
+            task.cancel()
+            await asyncio.wait({task})
+    if task in done:
+        return task.result()
+
+    # The work may have finished while being cancelled; close any stream it opened
+    if not task.cancelled() and task.exception() is None and hasattr(task.result(), "aclose"):
+        await task.result().aclose()
+    raise ClientDisconnected()
+
+
+async def _maybe_await(result):
+    if inspect.isawaitable(result):
+        await result
+
+
+class GuardedStream:
+    """Async iterator that runs `cleanup` exactly once, when the stream ends,
+    fails or is closed, including when it is closed before it ever started.
+
+    `on_first` is called when the first chunk goes through, `on_chunk` with
+    every chunk.
+    """
+
+    def __init__(self, source, cleanup=None, on_first=None, on_chunk=None):
+        self.source = source
+        self.cleanup = cleanup
+        self.on_first = on_first
+        self.on_chunk = on_chunk
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            chunk = await self.source.__anext__()
+        except BaseException:
+            await self.aclose()
+            raise
+        if self.on_first is not None:
+            on_first, self.on_first = self.on_first, None
+            on_first()
+        if self.on_chunk is not None:
+            self.on_chunk(chunk)
+        return chunk
+
+    async def aclose(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if hasattr(self.source, "aclose"):
+                await self.source.aclose()
+        finally:
+            if self.cleanup is not None:
+                await _maybe_await(self.cleanup())
+
+
+class EventStreamResponse(StreamingResponse):
+    """An SSE StreamingResponse that notices client disconnects on every ASGI
+    version and always closes its body iterator, so upstream work is cancelled
+    and resources are released as soon as the client is gone.
+    """
+
+    def __init__(self, content, on_disconnect=None, media_type="text/event-stream", **kwargs):
+        super().__init__(content, media_type=media_type, **kwargs)
+        self.on_disconnect = on_disconnect
+
+    async def __call__(self, scope, receive, send):
+        streaming = asyncio.ensure_future(self.stream_response(send))
+        watcher = asyncio.ensure_future(wait_for_disconnect(receive))
+        disconnected = False
+        try:
+            await asyncio.wait({streaming, watcher}, return_when=asyncio.FIRST_COMPLETED)
+            # Report a disconnect before the body is closed, so its cleanup can tell it from a finished stream
+            if not streaming.done():
+                disconnected = True
+                self._disconnected()
+                streaming.cancel()
+                await asyncio.wait({streaming})
+            elif not streaming.cancelled() and isinstance(streaming.exception(), OSError):
+                disconnected = True
+                self._disconnected()
+            else:
+                streaming.result()
+        finally:
+            watcher.cancel()
+            if not streaming.done():
+                streaming.cancel()
+            if hasattr(self.body_iterator, "aclose"):
+                await self.body_iterator.aclose()
+
+        if self.background is not None and not disconnected:
+            await self.background()
+
+    def _disconnected(self):
+        if self.on_disconnect:
+            self.on_disconnect()
+
+
+def with_heartbeats(opening, interval):
+    """SSE stream that sends comment heartbeats every `interval` seconds until
+    the first real chunk is ready.
+
+    `opening` is an awaitable resolving to the async byte iterator to forward,
+    so response headers can go out before the upstream has answered.
+    """
+    state = {"task": asyncio.ensure_future(opening), "next": None}
+
+    async def frames():
+        task = state["task"]
+        while not task.done():
+            await asyncio.wait({task}, timeout=interval)
+            if not task.done():
+                yield HEARTBEAT
+
+        source = task.result().__aiter__()
+        pending = state["next"] = asyncio.ensure_future(source.__anext__())
+        while not pending.done():
+            await asyncio.wait({pending}, timeout=interval)
+            if not pending.done():
+                yield HEARTBEAT
+        try:
+            first = pending.result()
+        except StopAsyncIteration:
+            return
+        yield first
+        async for chunk in source:
+            yield chunk
+
+    async def cleanup():
+        for waiting in (state["next"], state["task"]):
+            if waiting is not None and not waiting.done():
+                waiting.cancel()
+                await asyncio.wait({waiting})
+        task = state["task"]
+        if not task.cancelled() and task.exception() is None and hasattr(task.result(), "aclose"):
+            await task.result().aclose()
+
+    return GuardedStream(frames(), cleanup=cleanup)
+
+
+def error_event(status_code, message):
+    # Headers are already sent, so errors travel in-band the way OpenAI streams report them
+    return f"data: {json.dumps({'error': {'message': message, 'code': status_code}})}\n\n".encode()
+
+
+def error_status(chunk):
+    """Status code of an in-band error event at the start of `chunk`, or None."""
+    if not chunk.startswith(ERROR_PREFIX):
+        return None
+    try:
+        return int(json.loads(chunk.split(b"\n\n", 1)[0][5:])["error"]["code"])
+    except Exception:
+        return 500
+
+
+async def error_stream(status_code, message):
+    yield error_event(status_code, message)
+    yield DONE
+
+
+def is_event_stream(response):
+    return response.headers.get("content-type", "").startswith("text/event-stream")
+
+
+async def relay(response):
+    # Upstream already speaks OpenAI-style SSE, so its bytes go out untouched
+    complete = True
+    try:
+        async for chunk in response.aiter_bytes():
+            complete = chunk.endswith(b"\n\n")
+            yield chunk
+    except httpx.HTTPError as e:
+        # End with an error event so clients and accounting can tell a cut-off answer from a finished one
+        logger.warning(f"Upstream stream interrupted: {e}")
+        if not complete:
+            yield b"\n\n"
+        yield error_event(502, f"Upstream stream interrupted: {e}")
+        yield DONE
+
+
+async def sse_events(source):
+    """Yields the data payload of each SSE event in a byte stream, up to [DONE].
+
+    Events may be split across chunks or several may share one chunk;
+    comments such as heartbeats are skipped.
+    """
+    buffer = b""
+    async for chunk in source:
+        buffer += chunk.replace(b"\r\n", b"\n")
+        while True:
+            end = buffer.find(b"\n\n")
+            if end < 0:
+                break
+            event, buffer = buffer[:end], buffer[end + 2:]
+            data = b"\n".join(line[5:].lstrip() for line in event.split(b"\n") if line.startswith(b"data:"))
+            if not data:
+                continue
+            if data == b"[DONE]":
+                return
+            yield data
+
+
+def _template(finish_reason):
+    # Serialize the chunk envelope once and split it around the content slot
+    envelope = {
+        "choices": [
+            {
+                "delta": {"content": _SENTINEL},
+                "finish_reason": finish_reason,
+            }
+        ]
+    }
+    head, tail = json.dumps(envelope, separators=(",", ":")).split(json.dumps(_SENTINEL))
+    return f"data: {head}".encode(), f"{tail}\n\n".encode()
+
+
+def _split_bytes(text, size):
+    # Cut on UTF-8 boundaries so no frame carries half a character
+    data = text.encode()
+    start = 0
+    while start < len(data):
+        end = min(start + size, len(data))
+        while end < len(data) and end > start + 1 and (data[end] & 0xC0) == 0x80:
+            end -= 1
+        yield data[start:end].decode()
+        start = end
+
+
+class Framer:
+    """Frames a finished completion as a synthetic OpenAI-style SSE stream.
+
+    Policies:
+        single: the whole completion in one frame
+        word:   one frame per word (trailing whitespace included)
+        bytes:  frames of at most `chunk_bytes` UTF-8 bytes
+        time:   frames holding `chars_per_second * slice_seconds` characters
+
+    With `pace` off, frames are coalesced into large writes. With it on, the
+    framer sleeps `slice_seconds` between frames to mimic typing.
+    """
+
+    def __init__(self, policy="single", chunk_bytes=64, slice_seconds=0.05, chars_per_second=400, pace=False):
+        if policy not in CHUNK_POLICIES:
+            raise ValueError(f"Unknown chunk policy {policy!r}, expected one of {CHUNK_POLICIES}")
+        self.policy = policy
+        self.chunk_bytes = max(4, chunk_bytes)
+        self.slice_seconds = slice_seconds
+        self.slice_chars = max(1, int(chars_per_second * slice_seconds))
+        self.pace = pace
+        self.head, self.tail = _template(None)
+        stop_head, stop_tail = _template("stop")
+        self.stop = stop_head + b'""' + stop_tail
+
+    def pieces(self, text):
+        if self.policy == "single":
+            if text:
+                yield text
+        elif self.policy == "word":
+            for match in _WORD.finditer(text):
+                yield match.group()
+        elif self.policy == "bytes":
+            yield from _split_bytes(text, self.chunk_bytes)
+        else:
+            for i in range(0, len(text), self.slice_chars):
+                yield text[i:i + self.slice_chars]
+
+    def frame(self, piece):
+        return self.head + json.dumps(piece, ensure_ascii=False).encode() + self.tail
+
+    def frames(self, text):
+        for piece in self.pieces(text):
+            yield self.frame(piece)
+        yield self.stop
+        yield DONE
+
+    async def stream(self, text):
+        if self.pace:
+            for i, frame in enumerate(self.frames(text)):
+                if i:
+                    await asyncio.sleep(self.slice_seconds)
+                yield frame
+            return
+
+        buffer = bytearray()
+        for frame in self.frames(text):
+            buffer += frame
+            if len(buffer) >= FLUSH_BYTES:
+                yield bytes(buffer)
+                buffer.clear()
+        if buffer:
+            yield bytes(buffer)
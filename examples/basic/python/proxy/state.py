@@ -0,0 +1,212 @@
+import os
+import time
+import asyncio
+import logging
+import sqlite3
+import tempfile
+import threading
+
+# Try to import Redis, which is optional
+try:
+    import redis.asyncio as aioredis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = "shapes-proxy:"
+
+# INCRBY that sets the TTL in the same step when the key has none
+INCR_SCRIPT = """
+local value = redis.call("INCRBY", KEYS[1], ARGV[1])
+if redis.call("PTTL", KEYS[1]) < 0 then
+    redis.call("PEXPIRE", KEYS[1], ARGV[2])
+end
+return value
+"""
+
+
+class State:
+    """Key/value store shared by the proxy's workers.
+
+    Values are bytes with a TTL in seconds; counters are integers created by
+    `incr`. Callers keep their own local copies and only come here on a local
+    miss or on a periodic sync, so a network backend is not on every request.
+    """
+
+    name = "state"
+
+    def __init__(self):
+        self._pending = set()
+        self.errors = 0
+
+    async def get(self, key):
+        raise NotImplementedError
+
+    async def set(self, key, value, ttl):
+        raise NotImplementedError
+
+    async def incr(self, key, amount, ttl):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+    def publish(self, key, value, ttl):
+        # Write in the background; a lost write only costs another worker a cache miss
+        task = asyncio.ensure_future(self.set(key, value, ttl))
+        self._pending.add(task)
+        task.add_done_callback(self._published)
+
+    def _published(self, task):
+        self._pending.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.errors += 1
+            logger.warning(f"Shared state write failed: {task.exception()}")
+
+    def stats(self):
+        return {"backend": self.name, "pending_writes": len(self._pending), "errors": self.errors}
+
+
+class MemoryState(State):
+    """In-process state, for a single worker."""
+
+    name = "memory"
+
+    def __init__(self):
+        super().__init__()
+        self.values = {}
+
+    def _live(self, key):
+        item = self.values.get(key)
+        if item is not None and item[1] < time.time():
+            del self.values[key]
+            return None
+        return item
+
+    async def get(self, key):
+        item = self._live(key)
+        return item[0] if item else None
+
+    async def set(self, key, value, ttl):
+        self.values[key] = (value, time.time() + ttl)
+
+    async def incr(self, key, amount, ttl):
+        item = self._live(key)
+        value = (item[0] if item else 0) + amount
+        self.values[key] = (value, item[1] if item else time.time() + ttl)
+        return value
+
+
+class SharedMemoryState(State):
+    """State shared by the workers of one host.
+
+    Backed by an SQLite file in /dev/shm, so it lives in memory and needs no
+    extra service; SQLite's locking keeps concurrent workers consistent.
+    Queries run in a thread, so a worker waiting on another's write lock
+    does not stall its event loop.
+    """
+
+    name = "shm"
+
+    def __init__(self, path=None):
+        super().__init__()
+        if not path:
+            directory = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+            path = os.path.join(directory, "shapes-proxy-state.db")
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=5, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB, expires REAL)")
+        # One connection shared by the threads running queries; transactions must not interleave
+        self.lock = threading.Lock()
+        self.writes = 0
+
+    async def get(self, key):
+        return await asyncio.to_thread(self._get, key)
+
+    async def set(self, key, value, ttl):
+        await asyncio.to_thread(self._set, key, value, ttl)
+
+    async def incr(self, key, amount, ttl):
+        return await asyncio.to_thread(self._incr, key, amount, ttl)
+
+    def _get(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT value FROM kv WHERE key = ? AND expires >= ?", (key, time.time())).fetchone()
+        return row[0] if row else None
+
+    def _set(self, key, value, ttl):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO kv VALUES (?, ?, ?)", (key, value, time.time() + ttl))
+            self._written()
+
+    def _incr(self, key, amount, ttl):
+        with self.lock:
+            now = time.time()
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute("SELECT value, expires FROM kv WHERE key = ?", (key,)).fetchone()
+                if row is None or row[1] < now:
+                    value, expires = amount, now + ttl
+                else:
+                    value, expires = int(row[0]) + amount, row[1]
+                self.db.execute("INSERT OR REPLACE INTO kv VALUES (?, ?, ?)", (key, value, expires))
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self._written()
+        return value
+
+    def _written(self):
+        self.writes += 1
+        if self.writes % 1000 == 0:
+            self.db.execute("DELETE FROM kv WHERE expires < ?", (time.time(),))
+
+    async def close(self):
+        with self.lock:
+            self.db.close()
+
+    def stats(self):
+        return {**super().stats(), "path": self.path}
+
+
+class RedisState(State):
+    """State shared across hosts through Redis."""
+
+    name = "redis"
+
+    def __init__(self, url):
+        super().__init__()
+        if not REDIS_AVAILABLE:
+            raise RuntimeError("STATE_BACKEND=redis needs the redis package (pip install redis)")
+        self.redis = aioredis.from_url(url)
+        self._incr = self.redis.register_script(INCR_SCRIPT)
+
+    async def get(self, key):
+        return await self.redis.get(KEY_PREFIX + key)
+
+    async def set(self, key, value, ttl):
+        await self.redis.set(KEY_PREFIX + key, value, px=max(1, int(ttl * 1000)))
+
+    async def incr(self, key, amount, ttl):
+        # One script, so a counter is never left without its TTL
+        return await self._incr(keys=[KEY_PREFIX + key], args=[amount, max(1, int(ttl * 1000))])
+
+    async def close(self):
+        await self.redis.aclose()
+
+
+def make_state(spec):
+    # "memory", "shm", "shm:/path/to/file.db" or a redis:// / rediss:// URL
+    spec = (spec or "memory").strip()
+    if spec == "memory":
+        return MemoryState()
+    if spec == "shm" or spec.startswith("shm:"):
+        return SharedMemoryState(spec[4:] or None)
+    if spec.startswith(("redis://", "rediss://", "unix://")):
+        return RedisState(spec)
+    raise ValueError(f"Unknown STATE_BACKEND {spec!r}, expected memory, shm[:path] or a redis:// URL")
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The proxy modules live next to this folder rather than in an installed package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,215 @@
+import asyncio
+
+import pytest
+
+from scheduler import QueueFull, Scheduler
+
+
+async def settle():
+    # Let every runnable task reach its next await
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+async def run_in_order(scheduler, users):
+    """Queue one request per entry of `users` behind a held slot and return the order they ran in."""
+    held = await scheduler.acquire("holder", "holder")
+    order = []
+
+    async def request(user):
+        ticket = await scheduler.acquire(user, user)
+        order.append(user)
+        await asyncio.sleep(0)
+        scheduler.release(ticket)
+
+    tasks = []
+    for user in users:
+        tasks.append(asyncio.create_task(request(user)))
+        await settle()
+    scheduler.release(held)
+    await asyncio.gather(*tasks)
+    return order
+
+
+def test_runs_immediately_under_the_cap():
+    async def scenario():
+        scheduler = Scheduler(max_concurrency=2)
+        accepted = []
+        first = await scheduler.acquire("alice", "c1", accepted=lambda: accepted.append(1))
+        second = await scheduler.acquire("bob", "c2")
+        assert scheduler.active == 2
+        assert accepted == [1]
+        scheduler.release(first)
+        scheduler.release(second)
+        assert scheduler.active == 0
+        assert scheduler.tenants == {}
+        assert scheduler.channels == {}
+
+    asyncio.run(scenario())
+
+
+def test_equal_weights_alternate_between_users():
+    async def scenario():
+        scheduler = Scheduler(max_concurrency=1)
+        return await run_in_order(scheduler, ["alice", "alice", "alice", "bob", "bob"])
+
+    assert asyncio.run(scenario()) == ["alice", "bob", "alice", "bob", "alice"]
+
+
+def test_backlogged_user_does_not_starve_a_newcomer():
+    async def scenario():
+        scheduler = Scheduler(max_concurrency=1)
+        return await run_in_order(scheduler, ["alice"] * 4 + ["bob"])
+
+    assert asyncio.run(scenario()) == ["alice", "bob", "alice", "alice", "alice"]
+
+
+def test_weights_set_the_share_of_slots():
+    async def scenario():
+        scheduler = Scheduler(max_concurrency=1, weights={"alice": 2.0})
+        return await run_in_order(scheduler, ["alice"] * 4 + ["bob"] * 2)
+
+    # alice's tags are 0.5, 1, 1.5, 2 and bob's are 1, 2
+    assert asyncio.run(scenario()) == ["alice", "alice", "bob", "alice", "alice", "bob"]
+
+
+def test_per_user_cap_lets_other_users_through():
+    async def scenario():
+        scheduler = Scheduler(max_concurrency=4, per_user=1)
+        alice = await scheduler.acquire("alice", "c1")
+        waiting = asyncio.create_task(scheduler.acquire("alice", "c1"))
+        await settle()
+        assert not waiting.done()
+        bob = await scheduler.acquire("bob", "c2")
+        scheduler.release(alice)
+        await settle()
+        scheduler.release(await waiting)
+        scheduler.release(bob)
+        assert scheduler.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_full_queue_rejects_with_retry_after():
+    async def scenario():
+        scheduler = Scheduler(max_concurrency=1, max_queue=1)
+        held = await scheduler.acquire("alice", "c1")
+        waiting = asyncio.create_task(scheduler.acquire("bob", "c2"))
+        await settle()
+
+        accepted = []
+        with pytest.raises(QueueFull) as rejected:
+            await scheduler.acquire("carol", "c3", accepted=lambda: accepted.append(1))
+        assert rejected.value.retry_after >= 1
+        assert accepted == []
+        assert scheduler.rejected == 1
+        assert "carol" not in scheduler.tenants
+
+        scheduler.release(held)
+        scheduler.release(await waiting)
+
+    asyncio.run(scenario())
+
+
+def test_per_user_queue_limit():
+    async def scenario():
+        scheduler = Scheduler(max_concurrency=1, max_queue_per_user=1)
+        held = await scheduler.acquire("holder", "c0")
+        waiting = asyncio.create_task(scheduler.acquire("alice", "c1"))
+        await settle()
+
+        with pytest.raises(QueueFull):
+            await scheduler.acquire("alice", "c1")
+        # Other users still have room
+        other = asyncio.create_task(scheduler.acquire("bob", "c2"))
+        await settle()
+        assert scheduler.queued == 2
+
+        scheduler.release(held)
+        scheduler.release(await waiting)
+        scheduler.release(await other)
+
+    asyncio.run(scenario())
+
+
+def test_wait_longer_than_max_wait_times_out():
+    async def scenario():
+        scheduler = Scheduler(max_concurrency=1, max_wait=0.05)
+        held = await scheduler.acquire("alice", "c1")
+
+        with pytest.raises(QueueFull) as timed_out:
+            await scheduler.acquire("bob", "c2")
+        assert "Timed out" in str(timed_out.value)
+        assert scheduler.timed_out == 1
+        assert scheduler.queued == 0
+        assert "bob" not in scheduler.tenants
+
+        scheduler.release(held)
+        assert scheduler.active == 0
+
+    asyncio.run(scenario())
+
+
+def test_cancel_while_queued_frees_the_place():
+    async def scenario():
+        scheduler = Scheduler(max_concurrency=1)
+        held = await scheduler.acquire("alice", "c1")
+        cancelled = asyncio.create_task(scheduler.acquire("bob", "c2"))
+        behind = asyncio.create_task(scheduler.acquire("carol", "c3"))
+        await settle()
+        assert scheduler.queued == 2
+
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        assert scheduler.queued == 1
+        assert "bob" not in scheduler.tenants
+
+        # The freed slot goes to the next waiter, not the cancelled one
+        scheduler.release(held)
+        ticket = await behind
+        assert ticket.user == "carol"
+        assert scheduler.active == 1
+        scheduler.release(ticket)
+        assert scheduler.active == 0
+        assert scheduler.queued == 0
+
+    asyncio.run(scenario())
+
+
+def test_cancel_after_dispatch_releases_the_slot():
+    async def scenario():
+        scheduler = Scheduler(max_concurrency=1)
+        held = await scheduler.acquire("alice", "c1")
+        waiting = asyncio.create_task(scheduler.acquire("bob", "c2"))
+        await settle()
+
+        # The slot is handed over, then the waiter is cancelled before it resumes.
+        # Either the cancel wins and acquire gives the slot back, or the ticket
+        # is returned for the caller to release; the slot is never lost.
+        scheduler.release(held)
+        waiting.cancel()
+        try:
+            scheduler.release(await waiting)
+        except asyncio.CancelledError:
+            pass
+        assert scheduler.active == 0
+        assert scheduler.tenants == {}
+
+    asyncio.run(scenario())
+
+
+def test_raising_the_limit_dispatches_waiters():
+    async def scenario():
+        scheduler = Scheduler(max_concurrency=1)
+        held = await scheduler.acquire("alice", "c1")
+        waiting = asyncio.create_task(scheduler.acquire("bob", "c2"))
+        await settle()
+
+        scheduler.set_limit(2)
+        ticket = await waiting
+        assert scheduler.active == 2
+        scheduler.release(ticket)
+        scheduler.release(held)
+
+    asyncio.run(scenario())
@@ -0,0 +1,650 @@
+import time
+import random
+import socket
+import asyncio
+import logging
+import ipaddress
+from collections import deque
+
+import httpx
+
+# HTTP/2 needs the optional `h2` package (pip install "httpx[http2]")
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Record TTLs need `dnspython` (in requirements.txt); without it addresses live for a fixed TTL
+try:
+    import dns.asyncresolver
+    DNS_AVAILABLE = True
+except ImportError:
+    DNS_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+
+class PoolStats:
+    """Counters for connection reuse and pool queueing, fed by httpcore trace events."""
+
+    def __init__(self):
+        self.requests = 0
+        self.in_flight = 0
+        self.new_connections = 0
+        self.tls_handshakes = 0
+        self.queued = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+
+    def snapshot(self, max_connections):
+        reused = self.requests - self.new_connections
+        return {
+            "requests": self.requests,
+            "in_flight": self.in_flight,
+            "max_connections": max_connections,
+            "new_connections": self.new_connections,
+            "tls_handshakes": self.tls_handshakes,
+            "reuse_rate": round(reused / self.requests, 4) if self.requests else 0.0,
+            "queued": self.queued,
+            "queue_wait_avg_ms": round(self.queue_wait_total / self.requests * 1000, 3) if self.requests else 0.0,
+            "queue_wait_max_ms": round(self.queue_wait_max * 1000, 3),
+        }
+
+
+class Target:
+    """One upstream base URL and API key, with passive health tracking and a circuit breaker.
+
+    After `failure_threshold` consecutive 429/5xx responses or connection
+    errors the breaker opens and the target is skipped for `cooldown` seconds
+    (or the upstream's Retry-After, if longer). After that it is half-open:
+    a recovery probe or a single live request decides whether it closes again.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, base_url, api_key, weight=1, failure_threshold=5, cooldown=30.0):
+        self.base_url = (base_url or "").rstrip("/")
+        self.api_key = api_key
+        self.weight = max(1, weight)
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.open_for = cooldown
+        self.outstanding = 0
+        self.current_weight = 0
+        self.requests = 0
+        self.errors = 0
+        self.trips = 0
+
+    def available(self):
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.open_for:
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN:
+            # Only one trial request at a time while half-open
+            return self.outstanding == 0
+        return self.state == self.CLOSED
+
+    def record(self, status_code=None, retry_after=None):
+        # status_code is None when the request failed without a response
+        if status_code is not None and status_code != 429 and status_code < 500:
+            self.failures = 0
+            if self.state != self.CLOSED:
+                logger.info(f"Upstream {self.name()} recovered")
+            self.state = self.CLOSED
+            return
+
+        self.errors += 1
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.trip(retry_after)
+
+    def trip(self, retry_after=None):
+        if self.state != self.OPEN:
+            self.trips += 1
+            logger.warning(f"Upstream {self.name()} ejected after {self.failures} failures")
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.open_for = max(self.cooldown, retry_after or 0)
+
+    def name(self):
+        key = f"...{self.api_key[-4:]}" if self.api_key and len(self.api_key) > 4 else "NOT SET"
+        return f"{self.base_url} ({key})"
+
+    def stats(self):
+        return {
+            "target": self.name(),
+            "weight": self.weight,
+            "state": self.state,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "errors": self.errors,
+            "consecutive_failures": self.failures,
+            "trips": self.trips,
+        }
+
+
+def _is_ip(host):
+    try:
+        ipaddress.ip_address(host)
+        return True
+    except ValueError:
+        return False
+
+
+class Resolver:
+    """Cache of upstream host addresses, refreshed in the background when their TTL runs out.
+
+    TTLs come from the DNS answer when dnspython is installed, otherwise every
+    address lives `ttl` seconds. A failed refresh keeps the previous
+    addresses and tries again after `min_ttl`. Requests rotate over a host's
+    addresses.
+    """
+
+    def __init__(self, ttl=60.0, min_ttl=5.0, max_ttl=3600.0):
+        self.ttl = ttl
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.entries = {}
+        self.lookups = 0
+        self.failures = 0
+        self._task = None
+
+    async def _lookup(self, host, port):
+        if DNS_AVAILABLE:
+            try:
+                answer = await dns.asyncresolver.resolve(host, "A")
+                return [r.address for r in answer], answer.rrset.ttl
+            except Exception as e:
+                # Names from /etc/hosts and the like are not in DNS
+                logger.debug(f"DNS lookup for {host} failed, using getaddrinfo: {e}")
+        infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        return list(dict.fromkeys(info[4][0] for info in infos)), self.ttl
+
+    async def resolve(self, host, port):
+        self.lookups += 1
+        entry = self.entries.get(host)
+        try:
+            addresses, ttl = await self._lookup(host, port)
+            if not addresses:
+                raise OSError(f"No addresses for {host}")
+        except Exception as e:
+            self.failures += 1
+            if entry is None:
+                raise
+            logger.warning(f"Refreshing {host} failed, keeping {entry['addresses']}: {e}")
+            entry["expires"] = time.monotonic() + self.min_ttl
+            return entry["addresses"]
+        ttl = min(max(ttl, self.min_ttl), self.max_ttl)
+        self.entries[host] = {"addresses": addresses, "port": port, "ttl": ttl, "expires": time.monotonic() + ttl, "next": 0}
+        return addresses
+
+    def address(self, host):
+        entry = self.entries.get(host)
+        if entry is None:
+            return None
+        addresses = entry["addresses"]
+        entry["next"] = (entry["next"] + 1) % len(addresses)
+        return addresses[entry["next"]]
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _refresh_loop(self):
+        while True:
+            now = time.monotonic()
+            due = min((entry["expires"] for entry in self.entries.values()), default=now + self.min_ttl)
+            await asyncio.sleep(max(0.0, due - now))
+            for host, entry in list(self.entries.items()):
+                if entry["expires"] <= time.monotonic():
+                    try:
+                        await self.resolve(host, entry["port"])
+                    except Exception:
+                        pass
+
+    def stats(self):
+        now = time.monotonic()
+        return {
+            "dnspython": DNS_AVAILABLE,
+            "lookups": self.lookups,
+            "failures": self.failures,
+            "hosts": {
+                host: {"addresses": entry["addresses"], "ttl": entry["ttl"], "expires_in": round(entry["expires"] - now, 1)}
+                for host, entry in self.entries.items()
+            },
+        }
+
+
+def parse_targets(spec, base_url, api_key, failure_threshold=5, cooldown=30.0):
+    """Build targets from "url|key|weight,url|key|weight"; url and weight are optional.
+
+    With no spec, BASE_URL and API_KEY make up the single target.
+    """
+    targets = []
+    for item in (spec or "").split(","):
+        if not item.strip():
+            continue
+        parts = [part.strip() for part in item.split("|")]
+        url = parts[0] or base_url
+        key = parts[1] if len(parts) > 1 else api_key
+        weight = int(parts[2]) if len(parts) > 2 and parts[2] else 1
+        targets.append(Target(url, key, weight, failure_threshold, cooldown))
+    if not targets:
+        targets.append(Target(base_url, api_key, 1, failure_threshold, cooldown))
+    return targets
+
+
+# Failures while connecting, before the request was sent, so the upstream cannot have
+# started any work. Errors after that (e.g. RemoteProtocolError) may follow a generation
+# the upstream already began and bills for, so they are not retried.
+RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout)
+RETRYABLE_STATUS = (429, 503)
+
+
+def _retry_after(response):
+    try:
+        return float(response.headers.get("retry-after", ""))
+    except ValueError:
+        return None
+
+
+class Upstream:
+    """App-scoped, pooled HTTP client for the Shapes API.
+
+    Requests are spread over one or more targets by least outstanding
+    requests (weighted) or smooth weighted round robin, skipping targets
+    whose circuit breaker is open. All targets share one connection pool.
+
+    With a `resolver`, requests go to cached addresses of each target's host
+    (the Host header and TLS server name stay the original hostname), and
+    `warm_up` resolves every host and opens keep-alive connections ahead of
+    the first request.
+    """
+
+    def __init__(
+        self,
+        targets,
+        routing="least_outstanding",
+        probe_interval=10.0,
+        retries=2,
+        backoff_base=0.25,
+        backoff_max=4.0,
+        deadline=60.0,
+        hedge=False,
+        hedge_min_delay=0.5,
+        hedge_budget=0.1,
+        max_connections=100,
+        max_keepalive=20,
+        keepalive_expiry=30.0,
+        connect_timeout=5.0,
+        read_timeout=120.0,
+        pool_timeout=10.0,
+        http2=True,
+        resolver=None,
+    ):
+        if routing not in ("least_outstanding", "weighted_round_robin"):
+            raise ValueError(f"Unknown routing {routing!r}")
+        self.targets = targets
+        self.routing = routing
+        self.probe_interval = probe_interval
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.deadline = deadline
+        self.hedge = hedge
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_budget = hedge_budget
+        self.latencies = deque(maxlen=200)
+        self.latency_samples = 0
+        self._p95 = None
+        self._releasing = set()
+        self.retry_stats = {"retries": 0, "deadline_exceeded": 0, "hedges": 0, "hedge_wins": 0}
+        self.max_connections = max_connections
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.timeout = httpx.Timeout(
+            connect=connect_timeout,
+            read=read_timeout,
+            write=connect_timeout,
+            pool=pool_timeout,
+        )
+        if http2 and not HTTP2_AVAILABLE:
+            logger.warning("h2 is not installed, falling back to HTTP/1.1 keep-alive")
+            http2 = False
+        self.http2 = http2
+        self.stats = PoolStats()
+        self.client = None
+        self.prober = None
+        self.resolver = resolver
+        self.ready = False
+        self.warmup = None
+        self.open_responses = {}
+        # Called with the seconds spent opening each new connection, TLS included
+        self.on_connect = None
+
+    async def start(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                http2=self.http2,
+                limits=self.limits,
+                timeout=self.timeout,
+            )
+        if self.prober is None and self.probe_interval:
+            self.prober = asyncio.create_task(self._probe_loop())
+        if self.resolver is not None:
+            self.resolver.start()
+
+    async def warm_up(self, connections=4, timeout=10.0):
+        """Resolve every target host and open `connections` keep-alive
+        connections per target with concurrent GET /v1/models calls. An
+        HTTP/2 target multiplexes every request over one connection, so it
+        gets a single call. Marks the upstream ready when done, even if
+        parts of it failed.
+
+        The report counts the warm-up calls that succeeded and the new
+        connections the pool opened meanwhile.
+        """
+        started = time.perf_counter()
+        opened = self.stats.new_connections
+        report = {"resolved": 0, "requests": 0, "connections": 0, "errors": []}
+
+        async def resolve(target):
+            url = httpx.URL(target.base_url)
+            if _is_ip(url.host):
+                return
+            await self.resolver.resolve(url.host, url.port or (443 if url.scheme == "https" else 80))
+            report["resolved"] += 1
+
+        async def connect(target):
+            try:
+                await self.request_target(target, "GET", "/v1/models")
+                report["requests"] += 1
+            except Exception as e:
+                report["errors"].append(f"{target.name()}: {e}")
+
+        def per_target(target):
+            # HTTP/2 is only negotiated over TLS; plain http targets speak HTTP/1.1
+            if self.http2 and target.base_url.startswith("https://"):
+                return min(connections, 1)
+            return connections
+
+        async def run():
+            if self.resolver is not None:
+                results = await asyncio.gather(*(resolve(t) for t in self.targets), return_exceptions=True)
+                report["errors"].extend(str(r) for r in results if isinstance(r, Exception))
+            if connections > 0:
+                await asyncio.gather(*(connect(t) for t in self.targets for _ in range(per_target(t))))
+
+        try:
+            await asyncio.wait_for(run(), timeout)
+        except asyncio.TimeoutError:
+            report["errors"].append(f"Warm-up timed out after {timeout}s")
+        finally:
+            report["connections"] = self.stats.new_connections - opened
+            report["seconds"] = round(time.perf_counter() - started, 3)
+            self.warmup = report
+            self.ready = True
+            if report["errors"]:
+                logger.warning(f"Warm-up finished with errors: {report['errors']}")
+        return report
+
+    async def close(self):
+        if self.prober is not None:
+            self.prober.cancel()
+            self.prober = None
+        if self.resolver is not None:
+            await self.resolver.close()
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    def headers(self, target, extra=None):
+        headers = {"Authorization": f"Bearer {target.api_key}"}
+        if extra:
+            headers.update(extra)
+        return headers
+
+    def pick(self):
+        candidates = [t for t in self.targets if t.available()]
+        if not candidates:
+            # Everything is ejected: fail open on the target that reopens first
+            return min(self.targets, key=lambda t: t.opened_at + t.open_for)
+
+        if self.routing == "weighted_round_robin":
+            total = sum(t.weight for t in candidates)
+            for t in candidates:
+                t.current_weight += t.weight
+            best = max(candidates, key=lambda t: t.current_weight)
+            best.current_weight -= total
+            return best
+
+        return min(candidates, key=lambda t: (t.outstanding + 1) / t.weight)
+
+    async def _probe_loop(self):
+        # Recovery probes: a cheap GET /v1/models against targets whose cooldown is over
+        while True:
+            await asyncio.sleep(self.probe_interval)
+            for target in self.targets:
+                if target.state == Target.CLOSED or not target.available():
+                    continue
+                try:
+                    await self.request_target(target, "GET", "/v1/models")
+                except Exception as e:
+                    logger.info(f"Recovery probe to {target.name()} failed: {e}")
+                    target.record(None)
+
+    def _tracer(self, target, started):
+        # The first trace event marks the moment a request leaves the pool queue,
+        # either by opening a new connection or by writing to a reused one.
+        state = {"dequeued": False, "connecting": None}
+        connected = "connection.start_tls.complete" if target.base_url.startswith("https") else "connection.connect_tcp.complete"
+
+        async def trace(event_name, info):
+            if not state["dequeued"] and event_name.endswith(".started"):
+                state["dequeued"] = True
+                wait = time.perf_counter() - started
+                self.stats.queue_wait_total += wait
+                self.stats.queue_wait_max = max(self.stats.queue_wait_max, wait)
+            if event_name == "connection.connect_tcp.started":
+                state["connecting"] = time.perf_counter()
+            elif event_name == "connection.connect_tcp.complete":
+                self.stats.new_connections += 1
+            elif event_name == "connection.start_tls.complete":
+                self.stats.tls_handshakes += 1
+            if event_name == connected and state["connecting"] and self.on_connect:
+                self.on_connect(time.perf_counter() - state["connecting"])
+
+        return trace
+
+    def _enter(self, target):
+        self.stats.requests += 1
+        if self.stats.in_flight >= self.max_connections:
+            self.stats.queued += 1
+        self.stats.in_flight += 1
+        target.requests += 1
+        target.outstanding += 1
+        started = time.perf_counter()
+        return {"trace": self._tracer(target, started), "started": started}
+
+    def _exit(self, target):
+        self.stats.in_flight -= 1
+        target.outstanding -= 1
+
+    async def request(self, method, path, headers=None, **kwargs):
+        response = await self.send(method, path, headers=headers, **kwargs)
+        try:
+            await response.aread()
+        finally:
+            await self.release(response)
+        return response
+
+    async def send(self, method, path, headers=None, **kwargs):
+        """Send a request and return as soon as the response headers arrive.
+
+        Connection errors and 429/503 answers are retried with jittered
+        exponential backoff while the deadline allows, and slow requests may
+        be hedged. The body is left unread; pass the response to `release`
+        once done with it.
+        """
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            retry_in = min(self.backoff_max, self.backoff_base * 2 ** attempt) * random.random()
+            try:
+                if self.hedge:
+                    response = await self._send_hedged(method, path, headers, **kwargs)
+                else:
+                    response = await self._send_once(method, path, headers, **kwargs)
+            except RETRYABLE_ERRORS:
+                if attempt >= self.retries or time.monotonic() + retry_in >= deadline:
+                    raise
+            else:
+                if response.status_code not in RETRYABLE_STATUS or attempt >= self.retries:
+                    return response
+                retry_in = max(retry_in, _retry_after(response) or 0)
+                if time.monotonic() + retry_in >= deadline:
+                    self.retry_stats["deadline_exceeded"] += 1
+                    return response
+                await self.release(response)
+
+            attempt += 1
+            self.retry_stats["retries"] += 1
+            await asyncio.sleep(retry_in)
+
+    async def _send_hedged(self, method, path, headers, **kwargs):
+        # If the first attempt has no response headers after the p95 delay,
+        # race a duplicate against it and keep whichever answers first.
+        primary = asyncio.create_task(self._send_once(method, path, headers, **kwargs))
+        delay = self.hedge_delay()
+        if delay is None or self.retry_stats["hedges"] >= self.hedge_budget * self.stats.requests:
+            return await primary
+
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                self.retry_stats["hedges"] += 1
+                tasks.add(asyncio.create_task(self._send_once(method, path, headers, **kwargs)))
+
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not primary:
+                            self.retry_stats["hedge_wins"] += 1
+                        for other in done - {task}:
+                            self._discard(other)
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+                task.add_done_callback(self._discard)
+
+    def _discard(self, task):
+        # Release the losing response of a hedged pair, however it finished
+        if task.cancelled() or task.exception() is not None:
+            return
+        # Keep a reference until done, so the release is not garbage collected mid-way
+        releasing = asyncio.create_task(self.release(task.result()))
+        self._releasing.add(releasing)
+        releasing.add_done_callback(self._releasing.discard)
+
+    def hedge_delay(self):
+        if len(self.latencies) < 20:
+            return None
+        if self._p95 is None:
+            ordered = sorted(self.latencies)
+            self._p95 = ordered[int(len(ordered) * 0.95) - 1]
+        return max(self.hedge_min_delay, self._p95)
+
+    def _pinned(self, url, headers, extensions):
+        # Connect to a cached address while keeping the hostname for Host and TLS
+        url = httpx.URL(url)
+        address = self.resolver.address(url.host)
+        if address is None:
+            return url
+        headers["Host"] = url.netloc.decode("ascii")
+        extensions["sni_hostname"] = url.host
+        return url.copy_with(host=address)
+
+    async def request_target(self, target, method, path, headers=None):
+        # One call to a specific target, bypassing routing and retries
+        extensions = self._enter(target)
+        headers = self.headers(target, headers)
+        url = f"{target.base_url}{path}"
+        if self.resolver is not None:
+            url = self._pinned(url, headers, extensions)
+        try:
+            response = await self.client.request(method, url, headers=headers, extensions=extensions)
+        finally:
+            self._exit(target)
+        target.record(response.status_code, _retry_after(response))
+        return response
+
+    async def _send_once(self, method, path, headers=None, **kwargs):
+        target = self.pick()
+        extensions = self._enter(target)
+        try:
+            headers = self.headers(target, headers)
+            url = f"{target.base_url}{path}"
+            if self.resolver is not None:
+                url = self._pinned(url, headers, extensions)
+            request = self.client.build_request(
+                method,
+                url,
+                headers=headers,
+                extensions=extensions,
+                **kwargs,
+            )
+            response = await self.client.send(request, stream=True)
+        except BaseException as e:
+            self._exit(target)
+            if isinstance(e, httpx.TransportError):
+                target.record(None)
+            raise
+
+        target.record(response.status_code, _retry_after(response))
+        self.open_responses[response] = target
+        if response.status_code < 400:
+            self.latencies.append(time.perf_counter() - extensions["started"])
+            self.latency_samples += 1
+            if self.latency_samples % 20 == 0:
+                self._p95 = None
+        return response
+
+    async def release(self, response):
+        try:
+            await response.aclose()
+        finally:
+            target = self.open_responses.pop(response, None)
+            if target is not None:
+                self._exit(target)
+
+    def pool_stats(self):
+        stats = self.stats.snapshot(self.max_connections)
+        stats["http2"] = self.http2
+        stats["routing"] = self.routing
+        stats.update(self.retry_stats)
+        delay = self.hedge_delay() if self.hedge else None
+        stats["hedge_delay_ms"] = round(delay * 1000, 3) if delay else None
+        stats["targets"] = [t.stats() for t in self.targets]
+        stats["dns"] = self.resolver.stats() if self.resolver is not None else None
+        stats["warmup"] = self.warmup
+        return stats
@@ -0,0 +1,365 @@
+import re
+import json
+import math
+import time
+import asyncio
+import logging
+import sqlite3
+from collections import OrderedDict
+
+from scheduler import QueueFull
+
+logger = logging.getLogger(__name__)
+
+FIELDS = (
+    "requests",
+    "errors",
+    "prompt_chars",
+    "completion_chars",
+    "prompt_tokens",
+    "completion_tokens",
+    "upstream_seconds",
+)
+
+# Rough characters per token, for answers that do not report usage
+CHARS_PER_TOKEN = 4
+
+# Content strings of answers and streamed chunks, still JSON-escaped
+_CONTENT = re.compile(rb'"content"\s*:\s*"((?:[^"\\]|\\.)*)"')
+
+# Token counts reported in a "usage" object
+_USAGE_COUNT = re.compile(rb'"(prompt_tokens|completion_tokens)"\s*:\s*(\d+)')
+
+# Bytes of an unterminated SSE event kept between chunks before scanning it anyway
+MAX_PENDING = 64 * 1024
+
+# Failed flushes in a row after which unwritten aggregates are dropped
+MAX_FLUSH_FAILURES = 5
+
+
+def estimate_tokens(chars):
+    return math.ceil(chars / CHARS_PER_TOKEN)
+
+
+def parse_quotas(spec):
+    # "alice=1000:5000,bob=:200" -> {"alice": (1000, 5000), "bob": (0, 200)}; 0 = no quota
+    quotas = {}
+    for item in (spec or "").split(","):
+        if "=" in item:
+            tenant, limits = item.rsplit("=", 1)
+            soft, _, hard = limits.partition(":")
+            quotas[tenant.strip()] = (float(soft or 0), float(hard or 0))
+    return quotas
+
+
+def _reported_usage(body):
+    # Token counts of the "usage" object in a JSON body, read without parsing the
+    # whole body; the object comes last, so search back from the end
+    start = body.rfind(b'"usage"')
+    if start < 0:
+        return None
+    return {name.decode(): int(value) for name, value in _USAGE_COUNT.findall(body, start)} or None
+
+
+def _text_length(raw):
+    # Characters in a JSON string body; only strings with escapes need decoding
+    if b"\\" not in raw:
+        return len(raw.decode(errors="replace"))
+    try:
+        return len(json.loads(b'"' + raw + b'"'))
+    except ValueError:
+        return len(raw)
+
+
+class Usage:
+    def __init__(self):
+        for field in FIELDS:
+            setattr(self, field, 0)
+
+    def add(self, other):
+        for field in FIELDS:
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+
+    def value(self, metric):
+        if metric == "tokens":
+            return self.prompt_tokens + self.completion_tokens
+        if metric == "chars":
+            return self.prompt_chars + self.completion_chars
+        return getattr(self, metric)
+
+    def as_dict(self):
+        data = {field: getattr(self, field) for field in FIELDS}
+        data["upstream_seconds"] = round(self.upstream_seconds, 3)
+        return data
+
+
+class UsageRequest:
+    """One upstream call being accounted.
+
+    Streams are measured as chunks pass: content lengths are read straight
+    from the JSON-escaped bytes, and only the rare events mentioning usage
+    or an error are parsed. At most one unterminated event is kept.
+    """
+
+    def __init__(self, tracker, tenant, prompt):
+        self.tracker = tracker
+        self.tenant = tenant
+        self.prompt = prompt or ""
+        self.started = time.perf_counter()
+        self.pending = b""
+        self.completion_chars = 0
+        self.reported = None
+        self.error = None
+        self.done = False
+
+    def chunk(self, chunk):
+        if not self.pending and chunk.endswith(b"\n\n"):
+            # Usual case: the chunk holds whole events
+            self._scan(chunk)
+            return
+        self.pending += chunk
+        end = self.pending.rfind(b"\n\n")
+        if end < 0:
+            if len(self.pending) > MAX_PENDING:
+                self._scan(self.pending)
+                self.pending = b""
+            return
+        events, self.pending = self.pending[:end], self.pending[end + 2:]
+        self._scan(events)
+
+    def _scan(self, events):
+        for match in _CONTENT.finditer(events):
+            self.completion_chars += _text_length(match.group(1))
+        if b'"usage"' not in events and b'"error"' not in events:
+            return
+        for line in events.split(b"\n"):
+            if not line.startswith(b"data:") or (b'"usage"' not in line and b'"error"' not in line):
+                continue
+            try:
+                data = json.loads(line[5:])
+            except ValueError:
+                continue
+            if not isinstance(data, dict):
+                continue
+            self.reported = data.get("usage") or self.reported
+            if isinstance(data.get("error"), dict):
+                self.error = data["error"].get("code") or 500
+
+    def finish(self, status, body=None):
+        if self.done:
+            return
+        self.done = True
+        if self.pending:
+            self._scan(self.pending)
+            self.pending = b""
+        if status == 200 and self.error is not None:
+            # An in-band error event ended the stream
+            status = self.error if isinstance(self.error, int) else 500
+        usage = Usage()
+        usage.requests = 1
+        usage.errors = int(status != 200)
+        usage.upstream_seconds = time.perf_counter() - self.started
+        usage.prompt_chars = len(self.prompt)
+        if body is not None and status == 200:
+            # A buffered answer: measured like a stream, without parsing the body
+            if body.lstrip().startswith(b"{"):
+                for match in _CONTENT.finditer(body):
+                    self.completion_chars += _text_length(match.group(1))
+                self.reported = _reported_usage(body)
+            else:
+                self._scan(body)
+        usage.completion_chars = self.completion_chars
+        reported = self.reported if isinstance(self.reported, dict) else {}
+        usage.prompt_tokens = reported.get("prompt_tokens") or estimate_tokens(usage.prompt_chars)
+        usage.completion_tokens = reported.get("completion_tokens") or estimate_tokens(usage.completion_chars)
+        self.tracker.record(self.tenant, usage)
+
+
+class UsageTracker:
+    """Per-tenant usage aggregates, flushed to an append-only log or SQLite.
+
+    Totals since startup and totals for the current quota period are kept in
+    memory and updated as calls finish. Quotas are read from the same period
+    counters: going over the soft quota is logged, and once the hard quota is
+    reached new calls raise QueueFull until the period ends. `metric` is what
+    quotas count: tokens, chars, requests or any usage field.
+
+    `sink` is a path: files ending in .db or .sqlite get one row per tenant and
+    period that flushes add to, anything else gets one JSON line per flush and
+    tenant.
+
+    Tenants come from a client-supplied header, so the in-memory tables keep
+    at most `max_tenants` of them, dropping the least recently active; their
+    usage stays in the sink. Aggregates waiting for a flush are only kept
+    with a sink, and dropped once MAX_FLUSH_FAILURES flushes in a row fail.
+    """
+
+    def __init__(
+        self,
+        sink=None,
+        flush_interval=30.0,
+        period=86400.0,
+        metric="tokens",
+        soft_quota=0,
+        hard_quota=0,
+        quotas=None,
+        max_tenants=10000,
+    ):
+        if metric not in ("tokens", "chars") + FIELDS:
+            raise ValueError(f"Unknown usage quota metric {metric!r}, expected tokens, chars or one of {FIELDS}")
+        self.sink = sink
+        self.flush_interval = flush_interval
+        self.period = period
+        self.metric = metric
+        self.default_quota = (soft_quota, hard_quota)
+        self.quotas = quotas or {}
+        self.max_tenants = max_tenants
+        self.totals = OrderedDict()
+        self.current = OrderedDict()
+        self.evicted = 0
+        self.current_period = self._period()
+        self.unflushed = {}
+        self.warned = set()
+        self.rejected = 0
+        self.flushes = 0
+        self.flush_errors = 0
+        self.failed_flushes = 0
+        self.dropped = 0
+        self._db = None
+        self._task = None
+
+    def _period(self):
+        return int(time.time() // self.period)
+
+    def start(self):
+        if self.sink:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self.sink:
+            await self.flush()
+        if self._db is not None:
+            self._db.close()
+
+    def begin(self, tenant, prompt):
+        return UsageRequest(self, tenant, prompt)
+
+    def _roll(self):
+        period = self._period()
+        if period != self.current_period:
+            self.current_period = period
+            self.current = OrderedDict()
+            self.warned.clear()
+
+    def check(self, tenant):
+        self._roll()
+        soft, hard = self.quotas.get(tenant, self.default_quota)
+        if not soft and not hard:
+            return
+        used = 0
+        if tenant in self.current:
+            self.current.move_to_end(tenant)
+            used = self.current[tenant].value(self.metric)
+        if hard and used >= hard:
+            self.rejected += 1
+            retry_after = max(1, math.ceil((self.current_period + 1) * self.period - time.time()))
+            raise QueueFull(f"Usage quota exceeded ({self.metric})", retry_after)
+        if soft and used >= soft and tenant not in self.warned:
+            self.warned.add(tenant)
+            logger.warning(f"Tenant {tenant} is over its soft {self.metric} quota: {used} of {soft}")
+
+    def record(self, tenant, usage):
+        self._roll()
+        tables = [(self.totals, tenant), (self.current, tenant)]
+        if self.sink:
+            tables.append((self.unflushed, (self.current_period, tenant)))
+        for table, key in tables:
+            aggregate = table.get(key)
+            if aggregate is None:
+                aggregate = table[key] = Usage()
+            aggregate.add(usage)
+        for table in (self.totals, self.current):
+            table.move_to_end(tenant)
+            while len(table) > self.max_tenants:
+                table.popitem(last=False)
+                if table is self.totals:
+                    self.evicted += 1
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        pending, self.unflushed = self.unflushed, {}
+        if not pending:
+            return
+        try:
+            await asyncio.to_thread(self._write, pending)
+            self.flushes += 1
+            self.failed_flushes = 0
+        except Exception as e:
+            self.flush_errors += 1
+            self.failed_flushes += 1
+            if self.failed_flushes >= MAX_FLUSH_FAILURES:
+                self.dropped += len(pending)
+                logger.error(f"Usage flush failed {self.failed_flushes} times in a row, dropping {len(pending)} aggregates: {e}")
+                return
+            logger.warning(f"Usage flush failed, keeping {len(pending)} aggregates for the next one: {e}")
+            for key, usage in pending.items():
+                self.unflushed.setdefault(key, Usage()).add(usage)
+
+    def _write(self, pending):
+        if self.sink.endswith((".db", ".sqlite")):
+            self._write_sqlite(pending)
+            return
+        now = round(time.time(), 3)
+        lines = []
+        for (period, tenant), usage in pending.items():
+            entry = {"ts": now, "period_start": int(period * self.period), "tenant": tenant, **usage.as_dict()}
+            lines.append(json.dumps(entry, separators=(",", ":")) + "\n")
+        with open(self.sink, "a", encoding="utf-8") as f:
+            f.writelines(lines)
+
+    def _write_sqlite(self, pending):
+        if self._db is None:
+            self._db = sqlite3.connect(self.sink, timeout=10, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS usage (period_start INTEGER, tenant TEXT, "
+                + ", ".join(f"{field} REAL DEFAULT 0" for field in FIELDS)
+                + ", PRIMARY KEY (period_start, tenant))"
+            )
+        columns = ", ".join(FIELDS)
+        updates = ", ".join(f"{field} = {field} + excluded.{field}" for field in FIELDS)
+        rows = [
+            (int(period * self.period), tenant, *(getattr(usage, field) for field in FIELDS))
+            for (period, tenant), usage in pending.items()
+        ]
+        with self._db:
+            self._db.executemany(
+                f"INSERT INTO usage (period_start, tenant, {columns}) VALUES (?, ?, {', '.join('?' * len(FIELDS))}) "
+                f"ON CONFLICT (period_start, tenant) DO UPDATE SET {updates}",
+                rows,
+            )
+
+    def top(self, n=10, by="tokens", current=False):
+        self._roll()
+        table = self.current if current else self.totals
+        ranked = sorted(table.items(), key=lambda item: item[1].value(by), reverse=True)[:n]
+        return [{"tenant": tenant, by: usage.value(by), **usage.as_dict()} for tenant, usage in ranked]
+
+    def stats(self):
+        return {
+            "tenants": len(self.totals),
+            "evicted_tenants": self.evicted,
+            "metric": self.metric,
+            "rejected": self.rejected,
+            "over_soft_quota": len(self.warned),
+            "flushes": self.flushes,
+            "flush_errors": self.flush_errors,
+            "dropped_aggregates": self.dropped,
+            "sink": self.sink,
+        }
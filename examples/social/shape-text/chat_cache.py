@@ -0,0 +1,130 @@
+"""
+MIT License
+
+Copyright (c) 2025 Shapes, Inc.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    A thread-safe, bounded LRU cache whose entries expire a fixed time after
+    they were stored.
+
+    Used as a read-through cache in front of Redis: readers note `version`
+    before going to Redis and pass it to `put`, so a value read before a
+    concurrent invalidation is not cached.
+    """
+
+    def __init__(self, max_size=10000, ttl=60):
+        """
+        Initialize the cache.
+
+        Args:
+            max_size (int): Maximum number of entries; the least recently used go first
+            ttl (float): Seconds an entry stays valid after it was stored
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """
+        Look up a key.
+
+        Args:
+            key (str): The cache key
+
+        Returns:
+            The cached value, or None on a miss or an expired entry
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                if entry is not None:
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, version=None):
+        """
+        Store a value, unless an invalidation happened since `version` was read.
+
+        Args:
+            key (str): The cache key
+            value: The value to cache
+            version (int, optional): `self.version` noted before the value was loaded
+        """
+        with self.lock:
+            if version is not None and version != self.version:
+                return
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key=None):
+        """
+        Drop one entry, or every entry when no key is given.
+
+        Args:
+            key (str, optional): The cache key to drop
+        """
+        with self.lock:
+            self.version += 1
+            self.invalidations += 1
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+    def stats(self):
+        """
+        Report size and hit ratio.
+
+        Returns:
+            dict: Cache statistics
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,257 @@
+"""
+MIT License
+
+Copyright (c) 2025 Shapes, Inc.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class ChatStore:
+    """
+    Bounded in-memory store of chat state, used when Redis is not available.
+
+    Each chat keeps one small tuple (shape username, operator message flag,
+    last access time), with shape usernames interned so chats talking to the
+    same shape share one string. Chats idle for longer than `ttl` expire, and
+    once `max_size` chats are stored the least recently active one is
+    dropped. With `snapshot_path` set, the store is loaded from that file on
+    startup and written back periodically and on exit, so restarts keep
+    shape selections.
+    """
+
+    def __init__(
+        self,
+        max_size=100000,
+        ttl=30 * 24 * 3600,
+        snapshot_path=None,
+        snapshot_interval=60,
+    ):
+        """
+        Initialize the store and load the snapshot if there is one.
+
+        Args:
+            max_size (int): Maximum number of chats kept
+            ttl (float): Seconds of inactivity after which a chat expires (0 = never)
+            snapshot_path (str, optional): JSON file to persist the store to
+            snapshot_interval (float): Seconds between snapshots of a changed store
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.dirty = False
+        self.expired = 0
+        self.evicted = 0
+        self.snapshots = 0
+        self.last_snapshot = None
+        self.snapshot_thread = None
+        if snapshot_path:
+            self.load()
+            atexit.register(self.snapshot)
+
+    def _expire(self, now):
+        # Entries are kept in order of last access, so the idle ones are first
+        if not self.ttl:
+            return
+        while self.entries:
+            chat_id, entry = next(iter(self.entries.items()))
+            if entry[2] + self.ttl >= now:
+                break
+            del self.entries[chat_id]
+            self.expired += 1
+            self.dirty = True
+
+    def get(self, chat_id):
+        """
+        Get a chat's state and mark it as active.
+
+        Args:
+            chat_id (str): The chat ID (user_id or channel_id)
+
+        Returns:
+            tuple: (shape username or None, operator message flag)
+        """
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(chat_id)
+            if entry is None:
+                return None, False
+            if self.ttl and entry[2] + self.ttl < now:
+                del self.entries[chat_id]
+                self.expired += 1
+                self.dirty = True
+                return None, False
+            self.entries[chat_id] = (entry[0], entry[1], now)
+            self.entries.move_to_end(chat_id)
+            self.dirty = True
+            return entry[0], entry[1]
+
+    def set(self, chat_id, shape_username=None, sent=None):
+        """
+        Update a chat's shape username and/or operator message flag.
+
+        Args:
+            chat_id (str): The chat ID (user_id or channel_id)
+            shape_username (str, optional): The shape username to set
+            sent (bool, optional): Whether the operator message was sent
+        """
+        now = time.time()
+        with self.lock:
+            shape, flag, _ = self.entries.get(chat_id, (None, False, now))
+            if shape_username is not None:
+                shape = sys.intern(shape_username)
+            if sent is not None:
+                flag = bool(sent)
+            self.entries[chat_id] = (shape, flag, now)
+            self.entries.move_to_end(chat_id)
+            self.dirty = True
+            self._expire(now)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evicted += 1
+        if self.snapshot_path and self.snapshot_thread is None:
+            self._start_snapshots()
+
+    def _start_snapshots(self):
+        with self.lock:
+            if self.snapshot_thread is not None:
+                return
+            self.snapshot_thread = threading.Thread(
+                target=self._snapshot_loop, name="chat-store-snapshot", daemon=True
+            )
+        self.snapshot_thread.start()
+
+    def _snapshot_loop(self):
+        while True:
+            time.sleep(self.snapshot_interval)
+            self.snapshot()
+
+    def load(self):
+        """
+        Load the store from its snapshot file, skipping chats that have expired.
+        """
+        try:
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            logger.warning(
+                f"Failed to load chat state snapshot {self.snapshot_path}: {str(e)}"
+            )
+            return
+        now = time.time()
+        with self.lock:
+            # Snapshots are written oldest first, keeping the LRU order
+            for chat_id, shape, flag, seen in data.get("chats", []):
+                self.entries[chat_id] = (
+                    sys.intern(shape) if shape else None,
+                    bool(flag),
+                    seen,
+                )
+            self._expire(now)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        logger.info(f"Loaded {len(self.entries)} chats from {self.snapshot_path}")
+
+    def snapshot(self):
+        """
+        Write the store to its snapshot file if it changed since the last one.
+
+        The file is written next to the snapshot and renamed over it, so a
+        crash mid-write never leaves a truncated snapshot.
+        """
+        if not self.snapshot_path:
+            return
+        with self.lock:
+            self._expire(time.time())
+            if not self.dirty:
+                return
+            chats = [[chat_id, *entry] for chat_id, entry in self.entries.items()]
+            self.dirty = False
+        tmp_path = f"{self.snapshot_path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"version": 1, "chats": chats}, f, separators=(",", ":"))
+            os.replace(tmp_path, self.snapshot_path)
+            self.snapshots += 1
+            self.last_snapshot = time.time()
+        except Exception as e:
+            self.dirty = True
+            logger.warning(
+                f"Failed to write chat state snapshot {self.snapshot_path}: {str(e)}"
+            )
+
+    def memory_bytes(self):
+        """
+        Estimate the memory held by the store: the dictionary, its keys and
+        entry tuples, and each distinct shape username once.
+
+        Returns:
+            int: Approximate size in bytes
+        """
+        with self.lock:
+            size = sys.getsizeof(self.entries)
+            shapes = {}
+            for chat_id, entry in self.entries.items():
+                size += (
+                    sys.getsizeof(chat_id)
+                    + sys.getsizeof(entry)
+                    + sys.getsizeof(entry[2])
+                )
+                if entry[0] is not None:
+                    shapes[id(entry[0])] = entry[0]
+            return size + sum(sys.getsizeof(shape) for shape in shapes.values())
+
+    def stats(self):
+        """
+        Report size, expiry and snapshot counters and the memory footprint.
+
+        Returns:
+            dict: Store statistics
+        """
+        memory = self.memory_bytes()
+        with self.lock:
+            per_chat = round(memory / len(self.entries)) if self.entries else 0
+            return {
+                "chats": len(self.entries),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "expired": self.expired,
+                "evicted": self.evicted,
+                "memory_bytes": memory,
+                "bytes_per_chat": per_chat,
+                "snapshot_path": self.snapshot_path,
+                "snapshots": self.snapshots,
+                "last_snapshot": self.last_snapshot,
+            }
@@ -24,8 +24,11 @@ SOFTWARE.
 
 import os
 import re
+import time
+import uuid
 import logging
 import requests
+import threading
 import tempfile
 import subprocess
 from urllib.parse import urlparse
@@ -33,6 +36,9 @@ from flask import Flask, request
 from twilio.twiml.messaging_response import MessagingResponse
 from twilio.rest import Client
 from brain import Brain
+from worker_pool import WorkerPool
+from chat_cache import LRUCache
+from chat_store import ChatStore
 from dotenv import load_dotenv
 
 # Try to import Redis, which is optional
@@ -55,17 +61,67 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# In-memory store for user shape selections
-# Key: user_id or channel_id, Value: shape_username
-user_shape_mapping = {}
-
-# Track if operator message was already sent to a user/group
-# Key: user_id or channel_id, Value: boolean
-operator_msg_sent = {}
 
 # Default operator shape username
 OPERATOR_SHAPE = os.environ.get("OPERATOR_SHAPE_USERNAME", "operator")
 
+# Background workers that generate and send iMessage replies, so the Sendblue
+# webhook is acknowledged without waiting for the Shapes API
+imessage_pool = WorkerPool(
+    "imsg",
+    workers=int(os.environ.get("IMSG_WORKERS", 8)),
+    max_queue=int(os.environ.get("IMSG_QUEUE_SIZE", 1000)),
+)
+
+# Reply to SMS through the Twilio REST API from background workers instead of
+# inline TwiML
+SMS_ASYNC = os.environ.get("SMS_ASYNC", "false").lower() in ("1", "true", "yes")
+sms_pool = WorkerPool(
+    "sms",
+    workers=int(os.environ.get("SMS_WORKERS", 8)),
+    max_queue=int(os.environ.get("SMS_QUEUE_SIZE", 1000)),
+)
+
+# Twilio client shared by all sends, created on first use
+twilio_client = None
+twilio_client_lock = threading.Lock()
+
+# Seconds of inactivity after which a chat's Redis state expires (0 = never)
+CHAT_STATE_TTL = int(os.environ.get("CHAT_STATE_TTL", 30 * 24 * 3600))
+
+# Move chat state stored by older versions as separate string keys into the
+# per-chat hash the first time each chat is seen
+REDIS_MIGRATE_LEGACY_KEYS = os.environ.get("REDIS_MIGRATE_LEGACY_KEYS", "true").lower() in ("1", "true", "yes")
+
+# In-memory store for user shape selections and whether the operator message
+# was sent, used when Redis is not available. Bounded in size, expires idle
+# chats and optionally snapshots to a file so restarts keep selections.
+chat_store = ChatStore(
+    max_size=int(os.environ.get("CHAT_STORE_SIZE", 100000)),
+    ttl=int(os.environ.get("CHAT_STORE_TTL", CHAT_STATE_TTL)),
+    snapshot_path=os.environ.get("CHAT_STORE_SNAPSHOT") or None,
+    snapshot_interval=float(os.environ.get("CHAT_STORE_SNAPSHOT_INTERVAL", 60)),
+)
+
+# Local cache of chat state in front of Redis, so active chats do not go to
+# Redis on every message (CHAT_CACHE_TTL=0 disables it)
+CHAT_CACHE_SIZE = int(os.environ.get("CHAT_CACHE_SIZE", 10000))
+CHAT_CACHE_TTL = float(os.environ.get("CHAT_CACHE_TTL", 60))
+chat_cache = LRUCache(max_size=CHAT_CACHE_SIZE, ttl=CHAT_CACHE_TTL) if CHAT_CACHE_TTL > 0 else None
+
+# Redis pub/sub channel on which instances announce changed chats, so the
+# others drop them from their local cache
+CHAT_INVALIDATION_CHANNEL = "shape-text:invalidate"
+
+# Started on first use, so every worker process gets its own subscriber and ID
+chat_cache_listener = None
+chat_cache_listener_lock = threading.Lock()
+
+# Seconds between attempts to subscribe after a failure; the cache is bypassed meanwhile
+CHAT_CACHE_RETRY = 10
+chat_cache_retry_at = 0.0
+instance_id = None
+
 # Initialize Redis client if available and configured
 redis_client = None
 if REDIS_AVAILABLE:
@@ -77,7 +133,7 @@ if REDIS_AVAILABLE:
     
     if redis_url:
         try:
-            redis_client = redis.from_url(redis_url)
+            redis_client = redis.from_url(redis_url, decode_responses=True)
             redis_client.ping()  # Test connection
             logger.info("Connected to Redis using URL")
         except Exception as e:
@@ -100,49 +156,219 @@ if REDIS_AVAILABLE:
             redis_client = None
 
 
-def get_shape_username(chat_id):
+def chat_state_key(chat_id):
     """
-    Get the shape username for a chat ID, from Redis if available or fallback to memory.
+    Get the Redis key of the hash holding a chat's state.
     
     Args:
         chat_id (str): The chat ID (user_id or channel_id)
         
     Returns:
-        str or None: The shape username or None if not found
+        str: The Redis key
+    """
+    return f"shape-text:chat:{chat_id}"
+
+
+def migrate_chat_state(chat_id):
+    """
+    Move a chat's state from the old per-field string keys into its hash.
+    
+    Older versions stored `shape-text:{chat_id}` and `operator_msg:{chat_id}`
+    as separate strings. They are read once, written to the hash and deleted,
+    so each chat is migrated the first time it is seen.
+    
+    Args:
+        chat_id (str): The chat ID (user_id or channel_id)
+        
+    Returns:
+        dict: The migrated hash fields, empty if there was nothing to migrate
+    """
+    legacy_keys = [f"shape-text:{chat_id}", f"operator_msg:{chat_id}"]
+    shape, operator_msg = redis_client.mget(legacy_keys)
+    fields = {}
+    if shape is not None:
+        fields["shape"] = shape
+    if operator_msg is not None:
+        fields["operator_msg"] = operator_msg
+    if not fields:
+        return fields
+    
+    # Write the hash and drop the old keys in one round trip
+    pipe = redis_client.pipeline()
+    pipe.hset(chat_state_key(chat_id), mapping=fields)
+    if CHAT_STATE_TTL:
+        pipe.expire(chat_state_key(chat_id), CHAT_STATE_TTL)
+    pipe.delete(*legacy_keys)
+    pipe.execute()
+    logger.info(f"Migrated Redis state for {chat_id} to a hash")
+    return fields
+
+
+def start_chat_cache_listener():
+    """
+    Subscribe to chat invalidations from other instances, once per process.
+    
+    A background thread drops every chat announced on
+    CHAT_INVALIDATION_CHANNEL from the local cache. If the connection drops,
+    the whole cache is cleared since announcements may have been missed. If
+    subscribing fails, it is retried every CHAT_CACHE_RETRY seconds and the
+    cache is bypassed meanwhile.
+    
+    Returns:
+        bool: True if invalidations are being received, so the cache may be used
+    """
+    global chat_cache_listener, chat_cache_retry_at, instance_id
+    if chat_cache_listener is not None:
+        return True
+    if time.monotonic() < chat_cache_retry_at:
+        return False
+    with chat_cache_listener_lock:
+        if chat_cache_listener is not None:
+            return True
+        if time.monotonic() < chat_cache_retry_at:
+            return False
+        if instance_id is None:
+            instance_id = uuid.uuid4().hex
+
+        def on_invalidate(message):
+            sender, _, chat_id = message["data"].partition(":")
+            if sender != instance_id:
+                chat_cache.invalidate(chat_id)
+
+        def on_error(e, pubsub, thread):
+            logger.warning(f"Redis error in chat cache invalidation listener: {str(e)}")
+            chat_cache.invalidate()
+            time.sleep(1)
+
+        try:
+            pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(**{CHAT_INVALIDATION_CHANNEL: on_invalidate})
+            chat_cache_listener = pubsub.run_in_thread(sleep_time=1, daemon=True, exception_handler=on_error)
+            logger.info(f"Listening for chat cache invalidations on {CHAT_INVALIDATION_CHANNEL}")
+            return True
+        except Exception as e:
+            logger.warning(f"Failed to subscribe to chat cache invalidations, bypassing the cache: {str(e)}")
+            chat_cache_retry_at = time.monotonic() + CHAT_CACHE_RETRY
+            return False
+
+
+def get_chat_state(chat_id):
+    """
+    Get the shape username and operator message flag for a chat ID, from Redis
+    if available or fallback to memory.
+    
+    Both values live in one Redis hash, read with a single HGETALL that also
+    pushes back the hash's inactivity expiry. Chats read recently are served
+    from the local cache without going to Redis.
+    
+    Args:
+        chat_id (str): The chat ID (user_id or channel_id)
+        
+    Returns:
+        dict: "shape" (str or None) and "operator_msg_sent" (bool)
     """
     if redis_client:
+        # Serve active chats from the local cache, while other instances' changes reach it
+        caching = chat_cache is not None and start_chat_cache_listener()
+        if caching:
+            state = chat_cache.get(chat_id)
+            if state is not None:
+                return dict(state)
+            version = chat_cache.version
         try:
-            # Try to get from Redis using 'shape:' prefix
-            redis_key = f"shape-text:{chat_id}"
-            shape = redis_client.get(redis_key)
-            if shape:
-                return shape
+            # Read the hash and refresh its expiry in one round trip
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.hgetall(chat_state_key(chat_id))
+            if CHAT_STATE_TTL:
+                pipe.expire(chat_state_key(chat_id), CHAT_STATE_TTL)
+            fields = pipe.execute()[0]
+            if not fields and REDIS_MIGRATE_LEGACY_KEYS:
+                fields = migrate_chat_state(chat_id)
+            if fields:
+                state = {
+                    "shape": fields.get("shape") or None,
+                    "operator_msg_sent": fields.get("operator_msg") == "1",
+                }
+                if caching:
+                    chat_cache.put(chat_id, dict(state), version)
+                return state
         except Exception as e:
-            logger.warning(f"Redis error when getting shape for {chat_id}: {str(e)}")
+            logger.warning(f"Redis error when getting state for {chat_id}: {str(e)}")
     
-    # Fallback to in-memory dictionary
-    return user_shape_mapping.get(chat_id)
+    # Fallback to the in-memory store
+    shape_username, sent = chat_store.get(chat_id)
+    return {"shape": shape_username, "operator_msg_sent": sent}
 
 
-def set_shape_username(chat_id, shape_username):
+def set_chat_state(chat_id, shape_username=None, sent=None):
     """
-    Set the shape username for a chat ID, in Redis if available and in memory.
+    Update the shape username and/or operator message flag for a chat ID, in
+    Redis if available and in memory.
+    
+    The changed fields are written to the chat's hash with one pipelined HSET,
+    together with its inactivity expiry and an invalidation for the local
+    caches of other instances.
     
     Args:
         chat_id (str): The chat ID (user_id or channel_id)
-        shape_username (str): The shape username to set
+        shape_username (str, optional): The shape username to set
+        sent (bool, optional): Whether the operator message was sent
     """
-    # Always update the in-memory dictionary for fallback
-    user_shape_mapping[chat_id] = shape_username
+    fields = {}
+    
+    # Drop the local copy; the next read fetches the merged hash
+    if chat_cache:
+        chat_cache.invalidate(chat_id)
+    
+    # Always update the in-memory store for fallback
+    chat_store.set(chat_id, shape_username, sent)
+    if shape_username is not None:
+        fields["shape"] = shape_username
+    if sent is not None:
+        fields["operator_msg"] = "1" if sent else "0"
     
     # Update Redis if available
-    if redis_client:
+    if redis_client and fields:
         try:
-            # Store in Redis using 'shape:' prefix
-            redis_key = f"shape-text:{chat_id}"
-            redis_client.set(redis_key, shape_username)
+            pipe = redis_client.pipeline(transaction=False)
+            pipe.hset(chat_state_key(chat_id), mapping=fields)
+            if CHAT_STATE_TTL:
+                pipe.expire(chat_state_key(chat_id), CHAT_STATE_TTL)
+            if chat_cache:
+                # Tell the other instances to drop their cached copy
+                start_chat_cache_listener()
+                pipe.publish(CHAT_INVALIDATION_CHANNEL, f"{instance_id}:{chat_id}")
+            pipe.execute()
         except Exception as e:
-            logger.warning(f"Redis error when setting shape for {chat_id}: {str(e)}")
+            logger.warning(f"Redis error when setting state for {chat_id}: {str(e)}")
+    
+    # Again now that Redis holds the new state: a read that raced the write may have cached the old one
+    if chat_cache:
+        chat_cache.invalidate(chat_id)
+
+
+def get_shape_username(chat_id):
+    """
+    Get the shape username for a chat ID, from Redis if available or fallback to memory.
+    
+    Args:
+        chat_id (str): The chat ID (user_id or channel_id)
+        
+    Returns:
+        str or None: The shape username or None if not found
+    """
+    return get_chat_state(chat_id)["shape"]
+
+
+def set_shape_username(chat_id, shape_username):
+    """
+    Set the shape username for a chat ID, in Redis if available and in memory.
+    
+    Args:
+        chat_id (str): The chat ID (user_id or channel_id)
+        shape_username (str): The shape username to set
+    """
+    set_chat_state(chat_id, shape_username=shape_username)
 
 
 def get_operator_msg_sent(chat_id):
@@ -156,18 +382,7 @@ def get_operator_msg_sent(chat_id):
     Returns:
         bool: True if operator message was sent, False otherwise
     """
-    if redis_client:
-        try:
-            # Try to get from Redis using 'operator_msg:' prefix
-            redis_key = f"operator_msg:{chat_id}"
-            value = redis_client.get(redis_key)
-            if value is not None:
-                return value == "1"
-        except Exception as e:
-            logger.warning(f"Redis error when getting operator_msg for {chat_id}: {str(e)}")
-    
-    # Fallback to in-memory dictionary
-    return operator_msg_sent.get(chat_id, False)
+    return get_chat_state(chat_id)["operator_msg_sent"]
 
 
 def set_operator_msg_sent(chat_id, sent=True):
@@ -178,17 +393,7 @@ def set_operator_msg_sent(chat_id, sent=True):
         chat_id (str): The chat ID (user_id or channel_id)
         sent (bool): Whether the operator message was sent
     """
-    # Always update the in-memory dictionary for fallback
-    operator_msg_sent[chat_id] = sent
-    
-    # Update Redis if available
-    if redis_client:
-        try:
-            # Store in Redis using 'operator_msg:' prefix
-            redis_key = f"operator_msg:{chat_id}"
-            redis_client.set(redis_key, "1" if sent else "0")
-        except Exception as e:
-            logger.warning(f"Redis error when setting operator_msg for {chat_id}: {str(e)}")
+    set_chat_state(chat_id, sent=sent)
 
 
 def extract_shape_username(message):
@@ -213,22 +418,117 @@ def extract_shape_username(message):
     return None
 
 
+def generate_imessage_reply(incoming_msg, user_num, group_id):
+    """
+    Pick a shape for an incoming iMessage and generate the reply text.
+    
+    Args:
+        incoming_msg (str): The message content
+        user_num (str): The sender's phone number
+        group_id (str): The Sendblue group ID, empty for direct messages
+        
+    Returns:
+        str: The reply to send back to the chat
+    """
+    # Use group_id if available, otherwise use user_num
+    chat_id = group_id if group_id else user_num
+    
+    # Check if user/group has already selected a shape
+    chat_state = get_chat_state(chat_id)
+    shape_username = chat_state["shape"]
+    
+    # Extract shape username from message if it contains a shapes.inc URL
+    extracted_username = extract_shape_username(incoming_msg)
+    if extracted_username:
+        shape_username = extracted_username
+        set_chat_state(chat_id, shape_username, sent=False)  # Reset operator message flag
+        logger.info(f"Set shape for {chat_id} to {shape_username}")
+        
+        # Response message for shape selection
+        return f"Connecting you with {shape_username} now... You're all set! {shape_username} is now on the line and ready to chat with you."
+        
+    # If no shape is selected, check if operator message was already sent
+    if not shape_username:
+        if chat_state["operator_msg_sent"]:
+            # Auto-connect to operator if operator message was already sent
+            shape_username = OPERATOR_SHAPE
+            set_shape_username(chat_id, shape_username)
+            logger.info(f"Auto-connected {chat_id} to {shape_username}")
+            
+            # Let user know they're now connected to the operator
+            return f"You are now connected to {shape_username}."
+        
+        # Mark that operator message was sent
+        set_operator_msg_sent(chat_id, True)
+        
+        # Operator message for the first message
+        return "Hello, Shapes Switchboard here! I'll connect you with a Shape now. Who would you like to speak with today? Just visit https://shapes.inc to browse our directory, then send me their profile link (like https://shapes.inc/tenshi) and I'll connect you right away."
+    
+    # For direct messages (not groups), send typing indicator
+    # Typing indicators are only supported for direct messages
+    if not group_id:
+        send_typing_indicator(user_num)
+        
+    # Generate reply using Brain with selected shape
+    brain = Brain(
+        shape_username=shape_username,
+        user_id=user_num,
+    )
+    
+    return brain.generate_reply(
+        message=incoming_msg,
+        x_channel_id=group_id,
+    )
+
+
+def process_imessage(data, received_at):
+    """
+    Generate the reply to an incoming iMessage and send it via Sendblue.
+
+    Runs on the iMessage worker pool, after the webhook has been acknowledged.
+    Messages from the same chat are processed one at a time, in order.
+
+    Args:
+        data (dict): The Sendblue webhook payload
+        received_at (float): time.monotonic() when the webhook arrived
+    """
+    user_num = data["from_number"]
+    group_id = data.get("group_id", "")
+    
+    try:
+        reply = generate_imessage_reply(data["content"], user_num, group_id)
+    except Exception as e:
+        # The webhook was already acknowledged, so Sendblue will not retry it
+        logger.error(f"Error processing iMessage: {str(e)}")
+        reply = "Sorry, I'm having trouble processing your message right now."
+    
+    send_imessage(user_num, reply, group_id)
+    logger.info(f"Sent response to {user_num} in {time.monotonic() - received_at:.2f}s")
+
+
 @app.route("/imsg", methods=["GET", "POST"])
 def imsg_reply():
     """
     Respond to incoming iMessages from Sendblue with a reply from a Shapes character.
 
-    This endpoint receives messages from Sendblue's webhook, processes them through
-    the Shapes API, and returns a response.
+    This endpoint validates Sendblue's webhook and queues the message for the
+    iMessage worker pool, so the webhook is acknowledged right away while the
+    Shapes API call and the reply happen in the background. When the queue is
+    full a 503 is returned so Sendblue retries later.
     """
+    received_at = time.monotonic()
     try:
         # Parse JSON data from Sendblue webhook
-        data = request.get_json()
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return {"status": "error", "message": "Expected a JSON object"}, 400
         
         # Extract incoming message and user identifier
-        incoming_msg = data["content"]
-        user_num = data["from_number"]
-        to_number = data["to_number"]
+        incoming_msg = data.get("content")
+        user_num = data.get("from_number")
+        to_number = data.get("to_number")
+        if not user_num or not to_number:
+            return {"status": "error", "message": "Missing from_number or to_number"}, 400
 
         if not incoming_msg:
             logger.info("Empty message received")
@@ -242,95 +542,134 @@ def imsg_reply():
             logger.info("Skipping outbound message")
             return {"status": "success"}
         
-        # Determine if this is a group chat
-        group_id = data.get("group_id", "")
+        # Queue the message; messages from the same chat keep their order
+        chat_id = data.get("group_id") or user_num
+        if not imessage_pool.submit(chat_id, process_imessage, data, received_at, enqueued_at=received_at):
+            logger.warning(f"iMessage queue is full, asking Sendblue to retry message from {user_num}")
+            return {"status": "error", "message": "Too many messages queued, retry later"}, 503
         
-        # Use group_id if available, otherwise use user_num
-        chat_id = group_id if group_id else user_num
+        # Return acknowledgment to webhook
+        return {"status": "success"}
         
-        # Check if user/group has already selected a shape
-        shape_username = get_shape_username(chat_id)
+    except Exception as e:
+        logger.error(f"Error processing iMessage: {str(e)}")
+        # Return an error response
+        return {"status": "error", "message": str(e)}, 500
+
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    """
+    Report queue depth, worker utilization and end-to-end reply latency of the
+    background worker pools, the hit ratio of the local chat state cache and
+    the size and memory footprint of the in-memory chat store.
+    """
+    return {
+        "imessage": imessage_pool.stats(),
+        "sms": sms_pool.stats(),
+        "chat_cache": chat_cache.stats() if chat_cache else None,
+        "chat_store": chat_store.stats(),
+    }
+
+
+def generate_sms_reply(incoming_msg, user_num, group_id):
+    """
+    Pick a shape for an incoming SMS and generate the reply text.
+    
+    Args:
+        incoming_msg (str): The message body
+        user_num (str): The sender's phone number
+        group_id (str or None): The Twilio GroupSid for group conversations
         
-        # Extract shape username from message if it contains a shapes.inc URL
-        extracted_username = extract_shape_username(incoming_msg)
-        if extracted_username:
-            shape_username = extracted_username
+    Returns:
+        str: The reply to send back to the sender
+    """
+    # Use group_id if available, otherwise use user_num
+    chat_id = group_id if group_id else user_num
+    
+    # Check if user/group has already selected a shape
+    chat_state = get_chat_state(chat_id)
+    shape_username = chat_state["shape"]
+    
+    # Extract shape username from message if it contains a shapes.inc URL
+    extracted_username = extract_shape_username(incoming_msg)
+    if extracted_username:
+        shape_username = extracted_username
+        set_chat_state(chat_id, shape_username, sent=False)  # Reset operator message flag
+        logger.info(f"Set shape for {chat_id} to {shape_username}")
+        
+        # Confirm shape selection
+        return f"Connecting you with {shape_username} now... You're all set! {shape_username} is now on the line and ready to chat with you."
+        
+    # If no shape is selected, check if operator message was already sent
+    if not shape_username:
+        if chat_state["operator_msg_sent"]:
+            # Auto-connect to operator if operator message was already sent
+            shape_username = OPERATOR_SHAPE
             set_shape_username(chat_id, shape_username)
-            set_operator_msg_sent(chat_id, False)  # Reset operator message flag
-            logger.info(f"Set shape for {chat_id} to {shape_username}")
             
-            # Response message for shape selection
-            response_msg = f"Connecting you with {shape_username} now... You're all set! {shape_username} is now on the line and ready to chat with you."
+            # Create Brain with operator
+            brain = Brain(
+                shape_username=shape_username,
+                user_id=user_num,
+            )
             
-            # Send the response via Sendblue
-            send_imessage(user_num, response_msg, group_id)
+            # Generate reply from the operator
+            reply = brain.generate_reply(
+                message=incoming_msg,
+                x_channel_id=group_id,
+            )
             
-            # Return acknowledgment to webhook
-            return {"status": "success"}
+            logger.info(f"Auto-connected {chat_id} to {shape_username}")
             
-        # If no shape is selected, check if operator message was already sent
-        if not shape_username:
-            if get_operator_msg_sent(chat_id):
-                # Auto-connect to operator if operator message was already sent
-                shape_username = OPERATOR_SHAPE
-                set_shape_username(chat_id, shape_username)
-                
-                # Let user know they're now connected to the operator
-                connection_msg = f"You are now connected to {shape_username}."
-                send_imessage(user_num, connection_msg, group_id)
-                
-                logger.info(f"Auto-connected {chat_id} to {shape_username} and sent response")
-                return {"status": "success"}
-            else:
-                # Use default operator for the first message
-                shape_username = OPERATOR_SHAPE
-                
-                # Create Brain with operator
-                brain = Brain(
-                    shape_username=shape_username,
-                    user_id=user_num,
-                )
-                
-                # Generate operator message
-                operator_msg = "Hello, Shapes Switchboard here! I'll connect you with a Shape now. Who would you like to speak with today? Just visit https://shapes.inc to browse our directory, then send me their profile link (like https://shapes.inc/tenshi) and I'll connect you right away."
-                
-                # Send the operator message via Sendblue
-                send_imessage(user_num, operator_msg, group_id)
-                
-                # Mark that operator message was sent
-                set_operator_msg_sent(chat_id, True)
-                
-                # Return acknowledgment to webhook
-                return {"status": "success"}
-        
-        # For direct messages (not groups), send typing indicator
-        # Typing indicators are only supported for direct messages
-        if not group_id:
-            send_typing_indicator(user_num)
+            # Connection notice and reply
+            return f"You are now connected to {shape_username}.\n\n{reply}"
+        else:
+            # Generate operator message for the first message
+            operator_msg = "Hello, Shapes Switchboard here! I'll connect you with a Shape now. Who would you like to speak with today? Just visit shapes.inc to browse our directory, then send me their profile link (like shapes.inc/shoutingguy) and I'll connect you right away."
             
-        # Generate reply using Brain with selected shape
-        brain = Brain(
-            shape_username=shape_username,
-            user_id=user_num,
-        )
-        
-        reply = brain.generate_reply(
-            message=incoming_msg,
-            x_channel_id=group_id,
-        )
-        
-        # Send the response via Sendblue
-        send_imessage(user_num, reply, group_id)
-        
-        logger.info(f"Sent response from {shape_username} to {user_num}")
-        
-        # Return acknowledgment to webhook
-        return {"status": "success"}
-        
+            # Mark that operator message was sent
+            set_operator_msg_sent(chat_id, True)
+            
+            logger.info(f"Sending operator message to {user_num}")
+            return operator_msg
+        
+    # Generate reply using Brain with selected shape
+    brain = Brain(
+        shape_username=shape_username,
+        user_id=user_num,
+    )
+    
+    reply = brain.generate_reply(
+        message=incoming_msg,
+        x_channel_id=group_id,
+    )
+    
+    logger.info(f"Generated response from {shape_username} for {user_num}")
+    return reply
+
+
+def process_sms(incoming_msg, user_num, group_id, received_at):
+    """
+    Generate the reply to an SMS and send it through the Twilio REST API.
+    
+    Runs on the SMS worker pool when SMS_ASYNC is enabled. Messages from the
+    same sender are processed one at a time, in order.
+    
+    Args:
+        incoming_msg (str): The message body
+        user_num (str): The sender's phone number
+        group_id (str or None): The Twilio GroupSid for group conversations
+        received_at (float): time.monotonic() when the webhook arrived
+    """
+    try:
+        reply = generate_sms_reply(incoming_msg, user_num, group_id)
     except Exception as e:
-        logger.error(f"Error processing iMessage: {str(e)}")
-        # Return an error response
-        return {"status": "error", "message": str(e)}, 500
+        logger.error(f"Error processing SMS: {str(e)}")
+        reply = "Sorry, I'm having trouble processing your message right now."
+    
+    send_message(user_num, reply)
+    logger.info(f"Sent response to {user_num} in {time.monotonic() - received_at:.2f}s")
 
 
 @app.route("/sms", methods=["GET", "POST"])
@@ -339,8 +678,12 @@ def sms_reply():
     Respond to incoming SMS messages with a reply from a Shapes character.
     
     This endpoint receives SMS messages from Twilio, processes them through
-    the Shapes API, and returns a response.
+    the Shapes API, and returns a response. With SMS_ASYNC enabled it returns
+    empty TwiML right away and the reply is sent later through the Twilio
+    REST API from the SMS worker pool, so slow replies are not cut off by
+    Twilio's webhook timeout.
     """
+    received_at = time.monotonic()
     try:
         # Extract incoming message and user identifier
         incoming_msg = request.values["Body"]
@@ -351,89 +694,15 @@ def sms_reply():
         # Determine if this is a group chat
         group_id = request.values.get("GroupSid", None)
         
-        # Use group_id if available, otherwise use user_num
-        chat_id = group_id if group_id else user_num
-        
-        # Check if user/group has already selected a shape
-        shape_username = get_shape_username(chat_id)
-        
-        # Extract shape username from message if it contains a shapes.inc URL
-        extracted_username = extract_shape_username(incoming_msg)
-        if extracted_username:
-            shape_username = extracted_username
-            set_shape_username(chat_id, shape_username)
-            set_operator_msg_sent(chat_id, False)  # Reset operator message flag
-            logger.info(f"Set shape for {chat_id} to {shape_username}")
-            
-            # Create Twilio response confirming shape selection
-            resp = MessagingResponse()
-            resp.message(f"Connecting you with {shape_username} now... You're all set! {shape_username} is now on the line and ready to chat with you.")
-            return str(resp)
-            
-        # If no shape is selected, check if operator message was already sent
-        if not shape_username:
-            if get_operator_msg_sent(chat_id):
-                # Auto-connect to operator if operator message was already sent
-                shape_username = OPERATOR_SHAPE
-                set_shape_username(chat_id, shape_username)
-                
-                # Create Brain with operator
-                brain = Brain(
-                    shape_username=shape_username,
-                    user_id=user_num,
-                )
-                
-                # Generate reply from the operator
-                reply = brain.generate_reply(
-                    message=incoming_msg,
-                    x_channel_id=group_id,
-                )
-                
-                # Create Twilio response with connection notice and reply
-                resp = MessagingResponse()
-                resp.message(f"You are now connected to {shape_username}.\n\n{reply}")
-                
-                logger.info(f"Auto-connected {chat_id} to {shape_username} and sent response")
-                return str(resp)
-            else:
-                # Use default operator for the first message
-                shape_username = OPERATOR_SHAPE
-                
-                # Create Brain with operator
-                brain = Brain(
-                    shape_username=shape_username,
-                    user_id=user_num,
-                )
-                
-                # Generate operator message
-                operator_msg = "Hello, Shapes Switchboard here! I'll connect you with a Shape now. Who would you like to speak with today? Just visit shapes.inc to browse our directory, then send me their profile link (like shapes.inc/shoutingguy) and I'll connect you right away."
-                
-                # Create Twilio response
-                resp = MessagingResponse()
-                resp.message(operator_msg)
-                
-                # Mark that operator message was sent
-                set_operator_msg_sent(chat_id, True)
-                
-                logger.info(f"Sent operator message to {user_num}")
-                return str(resp)
-            
-        # Generate reply using Brain with selected shape
-        brain = Brain(
-            shape_username=shape_username,
-            user_id=user_num,
-        )
-        
-        reply = brain.generate_reply(
-            message=incoming_msg,
-            x_channel_id=group_id,
-        )
+        if SMS_ASYNC:
+            # Queue the message; messages from the same sender keep their order
+            if sms_pool.submit(user_num, process_sms, incoming_msg, user_num, group_id, received_at, enqueued_at=received_at):
+                return str(MessagingResponse())
+            logger.warning(f"SMS queue is full, replying inline to {user_num}")
         
         # Create Twilio response
         resp = MessagingResponse()
-        resp.message(reply)
-        
-        logger.info(f"Sent response from {shape_username} to {user_num}")
+        resp.message(generate_sms_reply(incoming_msg, user_num, group_id))
         return str(resp)
         
     except Exception as e:
@@ -444,6 +713,27 @@ def sms_reply():
         return str(resp)
 
 
+def get_twilio_client():
+    """
+    Get the process-wide Twilio client, creating it on first use.
+    
+    Reusing one client keeps its HTTP connection to the Twilio API alive
+    between messages.
+    
+    Returns:
+        Client: The Twilio REST client
+    """
+    global twilio_client
+    if twilio_client is None:
+        with twilio_client_lock:
+            if twilio_client is None:
+                # Get Twilio credentials from environment
+                account_sid = os.environ.get("TWILIO_ACCOUNT_SID")
+                auth_token = os.environ.get("TWILIO_AUTH_TOKEN")
+                twilio_client = Client(account_sid, auth_token)
+    return twilio_client
+
+
 def send_message(to, body):
     """
     Send an outgoing SMS message using Twilio.
@@ -456,16 +746,10 @@ def send_message(to, body):
         str: The Twilio message SID
     """
     try:
-        # Get Twilio credentials from environment
-        account_sid = os.environ.get("TWILIO_ACCOUNT_SID")
-        auth_token = os.environ.get("TWILIO_AUTH_TOKEN")
         from_number = os.environ.get("TWILIO_PHONE_NUMBER")
         
-        # Initialize Twilio client
-        client = Client(account_sid, auth_token)
-        
         # Send message
-        message = client.messages.create(
+        message = get_twilio_client().messages.create(
             body=body,
             from_=from_number,
             to=to
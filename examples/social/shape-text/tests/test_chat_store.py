@@ -0,0 +1,166 @@
+"""
+MIT License
+
+Copyright (c) 2025 Shapes, Inc.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import json
+
+from chat_store import ChatStore
+
+
+class Clock:
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def use_clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr("chat_store.time.time", clock)
+    return clock
+
+
+def test_defaults_for_unknown_chat():
+    store = ChatStore()
+    assert store.get("nobody") == (None, False)
+
+
+def test_set_updates_fields_independently():
+    store = ChatStore()
+    store.set("chat", shape_username="tenshi")
+    store.set("chat", sent=True)
+    assert store.get("chat") == ("tenshi", True)
+    store.set("chat", shape_username="other")
+    assert store.get("chat") == ("other", True)
+
+
+def test_shape_usernames_are_shared():
+    store = ChatStore()
+    store.set("one", shape_username="".join(["ten", "shi"]))
+    store.set("two", shape_username="".join(["ten", "shi"]))
+    assert store.entries["one"][0] is store.entries["two"][0]
+
+
+def test_idle_chats_expire(monkeypatch):
+    clock = use_clock(monkeypatch)
+    store = ChatStore(ttl=60)
+    store.set("old", shape_username="a")
+    clock.now += 30
+    store.set("recent", shape_username="b")
+
+    clock.now += 40
+    assert store.get("old") == (None, False)
+    assert store.get("recent") == ("b", False)
+    assert store.stats()["expired"] == 1
+
+    # Reading a chat keeps it alive
+    clock.now += 50
+    assert store.get("recent") == ("b", False)
+    clock.now += 50
+    store.set("new", sent=True)
+    assert list(store.entries) == ["recent", "new"]
+
+
+def test_expired_chats_are_dropped_on_write(monkeypatch):
+    clock = use_clock(monkeypatch)
+    store = ChatStore(ttl=60)
+    for i in range(5):
+        store.set(f"chat{i}", shape_username="a")
+    clock.now += 61
+    store.set("fresh", shape_username="b")
+    assert list(store.entries) == ["fresh"]
+    assert store.expired == 5
+
+
+def test_least_recently_active_chat_is_evicted(monkeypatch):
+    clock = use_clock(monkeypatch)
+    store = ChatStore(max_size=2)
+    store.set("a", shape_username="x")
+    clock.now += 1
+    store.set("b", shape_username="y")
+    clock.now += 1
+    store.get("a")
+    clock.now += 1
+    store.set("c", shape_username="z")
+
+    assert store.get("b") == (None, False)
+    assert store.get("a") == ("x", False)
+    assert store.get("c") == ("z", False)
+    assert store.stats()["evicted"] == 1
+
+
+def test_snapshot_round_trip(monkeypatch, tmp_path):
+    clock = use_clock(monkeypatch)
+    path = str(tmp_path / "chats.json")
+    store = ChatStore(ttl=60, snapshot_path=path, snapshot_interval=3600)
+    store.set("a", shape_username="x", sent=True)
+    clock.now += 1
+    store.set("b", shape_username="y")
+    clock.now += 1
+    store.set("c", sent=True)
+    store.snapshot()
+
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    assert data["version"] == 1
+    assert [chat[0] for chat in data["chats"]] == ["a", "b", "c"]
+
+    restored = ChatStore(ttl=60, snapshot_path=path, snapshot_interval=3600)
+    assert list(restored.entries) == ["a", "b", "c"]
+    assert restored.get("a") == ("x", True)
+    assert restored.get("b") == ("y", False)
+    assert restored.get("c") == (None, True)
+
+
+def test_snapshot_skips_expired_chats_and_unchanged_stores(monkeypatch, tmp_path):
+    clock = use_clock(monkeypatch)
+    path = str(tmp_path / "chats.json")
+    store = ChatStore(ttl=60, snapshot_path=path, snapshot_interval=3600)
+    store.set("a", shape_username="x")
+    store.snapshot()
+    store.snapshot()
+    assert store.snapshots == 1
+
+    # Chats that expired while the process was down are not loaded
+    clock.now += 61
+    restored = ChatStore(ttl=60, snapshot_path=path, snapshot_interval=3600)
+    assert restored.entries == {}
+
+
+def test_load_keeps_the_newest_chats_within_max_size(tmp_path):
+    path = str(tmp_path / "chats.json")
+    store = ChatStore(snapshot_path=path, snapshot_interval=3600)
+    for i in range(4):
+        store.set(f"chat{i}", shape_username="x")
+    store.snapshot()
+
+    restored = ChatStore(max_size=2, snapshot_path=path, snapshot_interval=3600)
+    assert list(restored.entries) == ["chat2", "chat3"]
+
+
+def test_corrupt_snapshot_starts_empty(tmp_path):
+    path = tmp_path / "chats.json"
+    path.write_text("{not json", encoding="utf-8")
+    store = ChatStore(snapshot_path=str(path))
+    assert store.entries == {}
@@ -0,0 +1,118 @@
+"""
+MIT License
+
+Copyright (c) 2025 Shapes, Inc.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import time
+import threading
+
+from worker_pool import WorkerPool
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("Timed out waiting for the pool")
+        time.sleep(0.005)
+
+
+def test_jobs_with_the_same_key_run_in_order_one_at_a_time():
+    pool = WorkerPool("test", workers=4)
+    lock = threading.Lock()
+    seen = {"a": [], "b": []}
+    running = {"a": 0, "b": 0}
+    overlapped = []
+
+    def job(key, i):
+        with lock:
+            running[key] += 1
+            if running[key] > 1:
+                overlapped.append(key)
+        time.sleep(0.001 * (i % 3))
+        with lock:
+            seen[key].append(i)
+            running[key] -= 1
+
+    for i in range(20):
+        assert pool.submit("a", job, "a", i)
+        assert pool.submit("b", job, "b", i)
+    wait_until(lambda: pool.stats()["processed"] == 40)
+
+    assert seen["a"] == list(range(20))
+    assert seen["b"] == list(range(20))
+    assert overlapped == []
+    assert pool.pending == {}
+
+
+def test_different_keys_run_in_parallel():
+    pool = WorkerPool("test", workers=2)
+    blocked = threading.Event()
+    done = threading.Event()
+
+    pool.submit("slow", blocked.wait, 5)
+    pool.submit("fast", done.set)
+
+    # The second chat is not stuck behind the first one
+    assert done.wait(5)
+    blocked.set()
+    wait_until(lambda: pool.stats()["processed"] == 2)
+
+
+def test_rejects_when_the_queue_is_full():
+    pool = WorkerPool("test", workers=1, max_queue=2)
+    release = threading.Event()
+    ran = []
+
+    pool.submit("a", release.wait, 5)
+    wait_until(lambda: pool.stats()["busy"] == 1)
+    assert pool.submit("a", ran.append, 1)
+    assert pool.submit("b", ran.append, 2)
+    assert not pool.submit("c", ran.append, 3)
+
+    stats = pool.stats()
+    assert stats["queue_depth"] == 2
+    assert stats["rejected"] == 1
+
+    release.set()
+    wait_until(lambda: pool.stats()["processed"] == 3)
+    assert sorted(ran) == [1, 2]
+    # Room again once the queue drained
+    assert pool.submit("c", ran.append, 3)
+    wait_until(lambda: pool.stats()["processed"] == 4)
+
+
+def test_failed_job_does_not_block_its_key():
+    pool = WorkerPool("test", workers=1)
+    ran = []
+
+    def fail():
+        raise RuntimeError("boom")
+
+    pool.submit("a", fail)
+    pool.submit("a", ran.append, "next")
+    wait_until(lambda: pool.stats()["processed"] == 2)
+
+    assert ran == ["next"]
+    stats = pool.stats()
+    assert stats["failed"] == 1
+    assert stats["latency_ms"]["max"] is not None
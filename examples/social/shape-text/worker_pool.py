@@ -0,0 +1,173 @@
+"""
+MIT License
+
+Copyright (c) 2025 Shapes, Inc.
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+"""
+
+import time
+import queue
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerPool:
+    """
+    A bounded pool of background threads for slow webhook work.
+
+    Jobs are submitted with a key (the chat ID). Jobs with the same key run
+    one at a time, in the order they were submitted, while jobs for
+    different keys run in parallel on up to `workers` threads. Once
+    `max_queue` jobs are waiting, new jobs are rejected so the caller can
+    ask the webhook sender to retry later.
+    """
+
+    def __init__(self, name, workers=8, max_queue=1000):
+        """
+        Initialize the pool. Threads are started on the first submit, so a
+        forking server starts them in each worker process.
+
+        Args:
+            name (str): Name used for thread names and log messages
+            workers (int): Number of worker threads
+            max_queue (int): Maximum number of jobs waiting to run
+        """
+        self.name = name
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self.lock = threading.Lock()
+        self.ready = queue.Queue()
+        self.pending = {}
+        self.queued = 0
+        self.busy = 0
+        self.busy_seconds = 0.0
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.latencies = deque(maxlen=1000)
+        self.started_at = None
+        self.threads = []
+
+    def _start(self):
+        self.started_at = time.monotonic()
+        for i in range(self.workers):
+            thread = threading.Thread(
+                target=self._run, name=f"{self.name}-{i}", daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, key, fn, *args, enqueued_at=None):
+        """
+        Queue `fn(*args)` to run after any earlier jobs with the same key.
+
+        Args:
+            key (str): Ordering key, usually the chat ID
+            fn (callable): The job
+            enqueued_at (float, optional): time.monotonic() when the work arrived,
+                for end-to-end latency; defaults to now
+
+        Returns:
+            bool: True if the job was queued, False if the queue is full
+        """
+        job = (fn, args, enqueued_at or time.monotonic())
+        with self.lock:
+            if not self.threads:
+                self._start()
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                return False
+            self.queued += 1
+            jobs = self.pending.get(key)
+            if jobs is not None:
+                # A job for this key is queued or running; run after it
+                jobs.append(job)
+                return True
+            self.pending[key] = deque([job])
+        self.ready.put(key)
+        return True
+
+    def _run(self):
+        while True:
+            key = self.ready.get()
+            with self.lock:
+                fn, args, enqueued_at = self.pending[key].popleft()
+                self.queued -= 1
+                self.busy += 1
+            started = time.monotonic()
+            try:
+                fn(*args)
+                failed = False
+            except Exception as e:
+                failed = True
+                logger.error(f"{self.name} job for {key} failed: {str(e)}")
+            finished = time.monotonic()
+            with self.lock:
+                self.busy -= 1
+                self.busy_seconds += finished - started
+                self.processed += 1
+                self.failed += failed
+                self.latencies.append(finished - enqueued_at)
+                if self.pending[key]:
+                    requeue = True
+                else:
+                    del self.pending[key]
+                    requeue = False
+            if requeue:
+                self.ready.put(key)
+
+    def stats(self):
+        """
+        Report queue depth, worker utilization and end-to-end latency.
+
+        Returns:
+            dict: Pool statistics
+        """
+        with self.lock:
+            latencies = sorted(self.latencies)
+            uptime = time.monotonic() - self.started_at if self.started_at else 0.0
+            capacity = uptime * self.workers
+            utilization = round(self.busy_seconds / capacity, 4) if capacity else 0.0
+
+            def percentile(p):
+                if not latencies:
+                    return None
+                index = min(len(latencies) - 1, int(p / 100 * len(latencies)))
+                return round(latencies[index] * 1000, 1)
+
+            return {
+                "workers": self.workers,
+                "busy": self.busy,
+                "queue_depth": self.queued,
+                "max_queue": self.max_queue,
+                "utilization": utilization,
+                "processed": self.processed,
+                "failed": self.failed,
+                "rejected": self.rejected,
+                "latency_ms": {
+                    "p50": percentile(50),
+                    "p95": percentile(95),
+                    "p99": percentile(99),
+                    "max": round(latencies[-1] * 1000, 1) if latencies else None,
+                },
+            }